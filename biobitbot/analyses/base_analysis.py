@@ -8,18 +8,46 @@ Reports are intended to parse data files and
 """
 
 
-import fnmatch
-import glob
+from collections import defaultdict
 import io
 import logging
+import mmap
 import os
 import random
+import re
 
 from biobitbot.utils import report, config
 logger = logging.getLogger(__name__)
 
 letters = 'abcdefghijklmnopqrstuvwxyz'
 
+def compile_contents_regex(strings):
+    """ Compile a list of strings into one bytes regex matching any of them """
+    strings = [m if isinstance(m, bytes) else m.encode('utf-8') for m in strings]
+    return re.compile(b'|'.join(re.escape(m) for m in strings))
+
+def search_file_contents(path, regex, decode=False):
+    """ Search a file for a compiled bytes regex over a memory-mapped view
+    of the file, stopping at the first match. The file is read once:
+    :param decode: return the contents decoded from the mapped buffer,
+                   with universal newlines like io.open in text mode
+    :return: None if there is no match, otherwise the file contents if
+             decode is set or True if not
+    """
+    with io.open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if regex.search(buf) is None:
+                return None
+            if decode:
+                # Translate newlines as reading in text mode would
+                return buf[:].decode('utf-8').replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+            return True
+        finally:
+            buf.close()
+
 class BaseIBotAnalysis(object):
 
     def __init__(self,name='base-analysis', anchor='base-analysis', target='',href='', info='', extra=''):
@@ -35,6 +63,7 @@ class BaseIBotAnalysis(object):
         :param patterns: Dict with keys 'fn' or 'contents' (or both). Keys can contain
         string or a list of strings. 'fn' matches filenames, 'contents' matches file contents.
         NB: Both searches return file if *any* of the supplied strings are matched.
+        A 'glob' key matches paths relative to the analysis directory instead.
         :param filehandles: Set to true to return a file handle instead of slurped file contents
         :return: Yields a set with two items - a sample name generated from the filename
                  and either the file contents or file handle for the current matched file.
@@ -56,14 +85,40 @@ class BaseIBotAnalysis(object):
             yield None
                 
         if glob_match != None:
-            for fname in glob.glob(glob_match):
+            # Glob patterns are relative to the analysis directory and are
+            # resolved against the manifest built by report.get_filelist()
+            for f in report.get_glob_matches(glob_match):
                 # Make a sample name from the filename
-                s_name = self.clean_s_name(fname, config.analysis_dir)
-                yield {'s_name': s_name, 'root': config.analysis_dir, 'fn': fname} 
+                s_name = self.clean_s_name(f['fn'], f['root'])
+                yield {'s_name': s_name, 'root': f['root'], 'fn': f['fn']}
 
         else:
+            # Make search strings into lists if a string is given
+            if type(fn_match) is str:
+                fn_match = [fn_match]
+            if type(contents_match) is str:
+                contents_match = [contents_match]
+            
+            # Look up the files matching each filename pattern in the index
+            # built by report.get_filelist(). Files that match more than one
+            # pattern are yielded once per pattern, in file order.
+            fn_matched_counts = defaultdict(int)
+            if fn_match is not None:
+                for m in fn_match:
+                    for i in report.get_pattern_matches(m):
+                        fn_matched_counts[i] += 1
+            
+            # Only a contents search needs to look at every file. All the
+            # contents strings are searched for at once with a single regex.
+            if contents_match is None:
+                candidates = sorted(fn_matched_counts.keys())
+            else:
+                candidates = range(len(report.files))
+                contents_regex = compile_contents_regex(contents_match)
+            
             # Loop through files, yield results if we find something
-            for f in report.files:
+            for i in candidates:
+                f = report.files[i]
                 
                 # Set up vars
                 root = f['root']
@@ -72,43 +127,30 @@ class BaseIBotAnalysis(object):
                 # # Make a sample name from the filename
                 s_name = self.clean_s_name(fn, root)
                 
-                # Make search strings into lists if a string is given
-                if type(fn_match) is str:
-                    fn_match = [fn_match]
-                if type(contents_match) is str:
-                    contents_match = [contents_match]
-
-
                 # Search for file names ending in a certain string
-                fn_matched = False
-                if fn_match is not None:
-                    for m in fn_match:
-                        if fnmatch.fnmatch(fn, m):
-                            fn_matched = True
-                            if not filehandles and not filecontents:
-                                yield {'s_name': s_name, 'root': root, 'fn': fn}
+                fn_matched = i in fn_matched_counts
+                if fn_matched and not filehandles and not filecontents:
+                    for _ in range(fn_matched_counts[i]):
+                        yield {'s_name': s_name, 'root': root, 'fn': fn}
                 
                 if fn_matched or contents_match is not None:
+                    path = os.path.join(root, fn)
                     try:
-                        with io.open (os.path.join(root,fn), "r", encoding='utf-8') as f:
-                            
-                            # Search this file for our string of interest
-                            returnfile = False
-                            if contents_match is not None and fn_matched is False:
-                                for line in f:
-                                    for m in contents_match:
-                                        if m in line:
-                                            returnfile = True
-                                            break
-                                f.seek(0)
-                            else:
-                                returnfile = True
-                            
-                            if returnfile:
-                                if filehandles:
-                                    yield {'s_name': s_name, 'f': f, 'root': root, 'fn': fn}
-                                elif filecontents:
-                                    yield {'s_name': s_name, 'f': f.read(), 'root': root, 'fn': fn}
+                        # Search this file for our string of interest
+                        contents = None
+                        if contents_match is not None and fn_matched is False:
+                            contents = search_file_contents(path, contents_regex, filecontents)
+                            if contents is None:
+                                continue
+                        
+                        if filehandles:
+                            with io.open (path, "r", encoding='utf-8') as f:
+                                yield {'s_name': s_name, 'f': f, 'root': root, 'fn': fn}
+                        elif filecontents:
+                            if contents is None:
+                                with io.open (path, "r", encoding='utf-8') as f:
+                                    contents = f.read()
+                            yield {'s_name': s_name, 'f': contents, 'root': root, 'fn': fn}
 
                     except (IOError, OSError, ValueError, UnicodeDecodeError):
                         if config.report_readerrors:
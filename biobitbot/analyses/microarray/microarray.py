@@ -7,12 +7,14 @@ import yaml
 import traceback
 from collections import OrderedDict
 import logging
+import os
 import re
 import csv
 from biobitbot import config
 from biobitbot.utils.errors import *
 from biobitbot.analyses.base_analysis import BaseIBotAnalysis
 from biobitbot.plots.sql_data_table import SqlDataTable
+from biobitbot.utils.parse_cache import cachedCountMatrix, cachedSqlDataTable
 import biobitbot.plots.scatterplot as scatter
 import biobitbot.plots.boxplot as boxplot
 from biobitbot.modules import markdown, distance, significance, pca
@@ -48,7 +50,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 		try:
 			overviewFiles = [f for f in self.find_log_files(config.sp['uarray']['overview'])]
 			assert len(overviewFiles) == 1
-			with open(overviewFiles[0]['fn']) as oF:
+			with open(os.path.join(overviewFiles[0]['root'], overviewFiles[0]['fn'])) as oF:
 				overview = oF.read()
 				overviewMod = markdown.IBotModule(name='Experiment Overview')
 				overviewMod.buildChartSet(overview)
@@ -69,9 +71,9 @@ class IBotAnalysis(BaseIBotAnalysis):
 		try:
 			pcaMod = pca.IBotModule()
 			pts = [f for f in self.find_log_files( config.sp['uarray']['pca']['points'])]
-			pts = pts[0]['fn']
+			pts = os.path.join(pts[0]['root'], pts[0]['fn'])
 			ve = [f for f in self.find_log_files( config.sp['uarray']['pca']['variance'])]
-			ve = ve [0]['fn']
+			ve = os.path.join(ve[0]['root'], ve[0]['fn'])
 			pcaMod.buildChartSet(pts,ve,self.conditions)
 			self.modules.append(pcaMod)
 		except Exception as e:
@@ -97,7 +99,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 		metaF = [f for f in self.find_log_files(config.sp['uarray']['metadata'])]
 		if len(metaF) != 1:
 			raise IBotMetadataError(len(metaF))
-		with openMaybeZip(metaF[0]['fn']) as mF:
+		with openMaybeZip(os.path.join(metaF[0]['root'], metaF[0]['fn'])) as mF:
 			metadata = yaml.load(mF)
 			conditions = metadata['conditions']
 			self.conditions = sorted(conditions,key=len,reverse=True)
@@ -113,32 +115,20 @@ class IBotAnalysis(BaseIBotAnalysis):
 
 	def parseNormExpTable(self):
 		tName = "norm_exp"
-		dt = SqlDataTable(tName)
 		norm_file = [f for f in self.find_log_files(config.sp['uarray']['norm_exp'])]
-		with openMaybeZip(norm_file[0]['fn']) as nF:
-			header = nF.readline()
-			header = [head.strip() for head in header.split()]
-			header = ['_'.join(head.split('.')) for head in header]
-			for head in header:
-				head = head.strip('"')
-				if head == "ids":
-					dt.addColumnInfo(head,"TEXT")
-				else:
-					dt.addColumnInfo(head,"FLOAT")	
-
-			dt.initSqlTable()
-			rdr = csv.reader(nF,delimiter='\t')
-			dt.addManyRows(rdr)
-		self.norm_table = dt
+		cleanHeader = lambda head: '_'.join(head.split('.'))
+		self.norm_table = cachedCountMatrix(os.path.join(norm_file[0]['root'], norm_file[0]['fn']), tName, 'ids',
+											dtype=config.count_matrix_dtype,
+											cleanHeader=cleanHeader)
 
 	def parseDiffExpTables(self):
 		diff_exp_files = [f for f in self.find_log_files(config.sp['uarray']['diff_exp'])]
 		self.diff_exp_tables = []
 
 		for f in diff_exp_files:
-			fname = f['fn']
+			fname = os.path.join(f['root'], f['fn'])
 			try:		
-				dET = parseDiffExpTable(fname)
+				dET = cachedSqlDataTable(fname, parseDiffExpTable, parseDiffExpTableVersion)
 				self.diff_exp_tables.append(dET)
 			except Exception as e:
 				logger.error("Failed to parse {} into diff exp table".format(fname))
@@ -148,7 +138,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 	def makeProbeGeneMaps(self):
 		probemap = [f for f in self.find_log_files(config.sp['uarray']['probemap'])]
 		assert len(probemap) == 1
-		with openMaybeZip(probemap[0]['fn']) as pM:
+		with openMaybeZip(os.path.join(probemap[0]['root'], probemap[0]['fn'])) as pM:
 			pM.readline()
 			self.probeToGenes = {}
 			self.genesToProbes = {}
@@ -161,6 +151,8 @@ class IBotAnalysis(BaseIBotAnalysis):
 					self.genesToProbes[gene].append(probe)
 
 
+parseDiffExpTableVersion = 1
+
 def parseDiffExpTable(filename):
 	tName = filename.split('/')[-1]
 	tName = tName.split('.')[0]
@@ -6,10 +6,12 @@ Based on the CGAT metagenome communities pipeline.
 """
 
 from biobitbot.plots.sql_data_table import SqlDataTable
+from biobitbot.utils.parse_cache import cachedCountMatrix, cachedSqlDataTable, cachedParse
 from collections import OrderedDict
-from tree import Tree, TreeNode
+from tree import Tree, Rollup, saveTree, loadTree
 from biobitbot.utils.utils import *
 import logging
+import os
 import re
 
 from biobitbot import config, plots
@@ -18,6 +20,7 @@ import biobitbot.plots.boxplot as boxplot
 import biobitbot.plots.scatterplot as scatter
 import biobitbot.plots.treemap as treemap
 import math
+import numpy as np
 from biobitbot.modules import distance, significance, pca, markdown, phylogeny, alpha_diversity, alignment_stats_ubiome
 from random import random
 import gzip
@@ -51,7 +54,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 		try:
 			overviewFiles = [f for f in self.find_log_files(config.sp['ubiome']['overview'])]
 			assert len(overviewFiles) == 1
-			with open(overviewFiles[0]['fn']) as oF:
+			with open(os.path.join(overviewFiles[0]['root'], overviewFiles[0]['fn'])) as oF:
 				overview = oF.read()
 				overviewMod = markdown.IBotModule(name='Experiment Overview')
 				overviewMod.buildChartSet(overview)
@@ -68,7 +71,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 			self.populateTreeSeqCounts()
 			self.parseAlignmentStatFiles()
 			astats = alignment_stats_ubiome.IBotModule()
-			astats.buildChartSet(self.taxa_hierarchy, self.phylo_tree, self.samples, self.alignment_stat_files)
+			astats.buildChartSet(self.taxa_hierarchy, self.rollup, self.samples, self.alignment_stat_files)
 			self.modules.append(astats)
 		except Exception as e:
 			logger.error("The alignment stats module broke in microbiome analysis.")
@@ -90,7 +93,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 			distMod = distance.IBotModule()
 			lowestTaxa = self.taxa_hierarchy[-1]
 			lowestCounts = self.norm_count_tables[lowestTaxa]
-			distMod.buildChartSet(lowestCounts,self.conditions.keys(),idcol='taxa')
+			distMod.buildChartSet(lowestCounts,self.conditions.keys())
 			self.modules.append(distMod)
 		except Exception as e:
 			logger.error("The distance module broke in microbiome analysis.")
@@ -100,9 +103,9 @@ class IBotAnalysis(BaseIBotAnalysis):
 		try:
 			pcaMod = pca.IBotModule()
 			pts = [f for f in self.find_log_files( config.sp['ubiome']['pca']['bacteria']['points'])]
-			pts = pts[0]['fn']
+			pts = os.path.join(pts[0]['root'], pts[0]['fn'])
 			ve = [f for f in self.find_log_files( config.sp['ubiome']['pca']['bacteria']['variance'])]
-			ve = ve[0]['fn']
+			ve = os.path.join(ve[0]['root'], ve[0]['fn'])
 			pcaMod.buildChartSet(pts,ve,self.conditions)
 			self.modules.append(pcaMod)
 		except Exception as e:
@@ -113,9 +116,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 		try:
 			self.parseDiffCountTables()
 			sigMod = significance.IBotModule()
-			for taxa in self.taxa_hierarchy[::-1]:
-				table = self.diff_count_tables[taxa]
-				sigMod.buildChartSet(taxa.title(),table,idcol='taxa',groups=None,strict=2)
+			sigMod.buildRankChartSets(self.diff_count_tables, self.taxa_hierarchy[::-1], idcol='taxa', strict=2)
 			self.modules.append(sigMod)
 		except Exception as e:
 			logger.error("The significance module broke in microbiome analysis")
@@ -128,7 +129,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 			self.populateTreeSeqCounts()
 			self.populateTreeNormCounts()
 			treeMod = phylogeny.IBotModule()
-			treeMod.buildChartSet(self.conditions,self.phylo_tree, self.taxa_hierarchy, self.root_offset)
+			treeMod.buildChartSet(self.conditions,self.phylo_tree, self.rollup, self.taxa_hierarchy)
 			self.modules.append(treeMod)
 		except Exception as e:
 			logger.error("The phylogeny tree module broke in microbiome analysis")
@@ -137,7 +138,7 @@ class IBotAnalysis(BaseIBotAnalysis):
 	def setMetadata(self):
 		metaF = [f for f in self.find_log_files(config.sp['ubiome']['metadata'])]
 		assert len(metaF) == 1
-		with open(metaF[0]['fn']) as mF:
+		with open(os.path.join(metaF[0]['root'], metaF[0]['fn'])) as mF:
 			metadata = yaml.load(mF)
 			samples = metadata['samples']
 			self.root_offset = int(metadata['taxa_offset'])
@@ -176,7 +177,10 @@ class IBotAnalysis(BaseIBotAnalysis):
 		diff_count_files = [f for f in diff_count_files if self.aligner in f['fn']]
 		diff_count_files = [f for f in diff_count_files if 'other' not in f['fn']]
 		assert len(diff_count_files) == len(self.taxa_hierarchy)
-		self.diff_count_tables = { self.getTaxaFromFilename(f['fn']) : parseDiffExpTable(f['fn']) for f in diff_count_files}
+		self.diff_count_tables = {}
+		for f in diff_count_files:
+			table = cachedSqlDataTable(os.path.join(f['root'], f['fn']), parseDiffExpTable, parseDiffExpTableVersion)
+			self.diff_count_tables[self.getTaxaFromFilename(f['fn'])] = table
 
 	def parseNormCountTables(self):
 		self.norm_count_tables = {}
@@ -184,27 +188,9 @@ class IBotAnalysis(BaseIBotAnalysis):
 			fn = f['fn']
 			taxa = self.getTaxaFromFilename(fn)
 			tName = "{}_norm_count".format(taxa)
-			dt = SqlDataTable(tName)
-			with open(fn) as nF:
-				header = nF.readline()
-				header = [head.strip() for head in header.split()]
-				header = ['_'.join(head.split('.')) for head in header]
-				
-				for head in header:
-					head = head.strip('"')
-					if '_count' in head:
-						head = head[:-6]
-
-					head = head.strip().strip('"')
-					if head == "taxa":
-						dt.addColumnInfo(head,"TEXT")
-					else:
-						dt.addColumnInfo(head,"FLOAT")	
-
-				dt.initSqlTable()
-				rdr = csv.reader(nF,delimiter='\t')
-				dt.addManyRows(rdr)
-			self.norm_count_tables[taxa] = dt
+			self.norm_count_tables[taxa] = cachedCountMatrix(os.path.join(f['root'], f['fn']), tName, 'taxa',
+												dtype=config.count_matrix_dtype,
+												cleanHeader=cleanNormCountHeader)
 			
 	def parseTreeFiles(self):
 		treeF = [f for f in self.find_log_files(config.sp['ubiome']['taxa_tree'])]
@@ -214,63 +200,41 @@ class IBotAnalysis(BaseIBotAnalysis):
 	def buildPhylogenyTree(self):
 		if hasattr(self,'phylo_tree'):
 			return
-		treeF = self.treeF
-		phyloRoot = TreeNode('ROOT', None)
-		with openMaybeZip(treeF['fn']) as tF:
-			header = tF.readline()
-			for line in tF:
-				hierarchy = line.split('\t')
-				assert len(hierarchy) == 7
-				rParent = phyloRoot
-				for i, taxon in enumerate(hierarchy):
-					rParent = rParent.addNameIfNotPresent(taxon.strip())
-
-		self.phylo_tree = Tree(phyloRoot, self.taxa_hierarchy)
+		treeFn = os.path.join(self.treeF['root'], self.treeF['fn'])
+		# The taxonomy is shared by many reports, so cache it by content rather than path
+		phyloTree = cachedParse(treeFn, 'phylogeny_tree', parsePhylogenyTreeVersion,
+								lambda: parsePhylogenyTree(treeFn, self.taxa_hierarchy, self.root_offset),
+								saveTree, loadTree, params=list(self.taxa_hierarchy) + [self.root_offset], byContent=True)
+		phyloTree.setSamples(self.samples.values())
+		self.phylo_tree = phyloTree
 
 	def populateTreeSeqCounts(self):
 		if hasattr(self,'tree_seq_counts_populated'):
 			return
+		# Samples missing from a count file keep a count of 0
+		seqCounts = self.phylo_tree.seqCounts
 		for countF in self.countFiles:
-			with openMaybeZip(countF['fn']) as cF:
+			with openMaybeZip(os.path.join(countF['root'], countF['fn'])) as cF:
 				cF.readline()
 				sample = self.getSampleFromFilename(countF['fn'])
+				col = self.phylo_tree.sampleIndex[sample]
 				for line in cF:
 					name, count = line.split()
-					count = int(count)
-	
-					self.phylo_tree.all_nodes[name].seqCountsBySamples[sample] = count
-
-		# We can miss samples if the taxa isn't present 
-		for node in self.phylo_tree:
-			for sample in self.samples.values():
-				if sample not in node.seqCountsBySamples:
-	
-					node.seqCountsBySamples[sample] = 0
-
-		for node in self.phylo_tree:
-			node.findSeqCountsThatDidNotAlignToChildren()
+					seqCounts[self.phylo_tree.nodeByName[name], col] = int(count)
+
+		self.phylo_tree.findSeqCountsThatDidNotAlignToChildren()
+		self.rollup = Rollup(self.phylo_tree, self.conditions)
 		self.tree_seq_counts_populated = True
 
 	def populateTreeNormCounts(self):
 		if hasattr(self,'tree_norm_counts_populated'):
 			return
-		for taxaRank, norm_table in self.norm_count_tables.items():
-			sqlCmd = "SELECT * FROM {table_name} "
-			cols, rows = norm_table.getTable(sqlCmd=sqlCmd)
-			for row in rows:
-				vals = row[:-1]
-				taxa = row[-1]
-				for col,val in zip(cols,vals):
-					sample = self.samples['-'.join(col.name.split('_'))]
-					self.phylo_tree.all_nodes[taxa].normCountsBySamples[sample] = val
-
-
-		# We can miss samples if the taxa isn't present 
-		for node in self.phylo_tree:
-			for sample in self.samples.values():
-				if sample not in node.normCountsBySamples:
-	
-					node.normCountsBySamples[sample] = 0.000001 # pseudocount
+		# Taxa missing from a table keep the tree's pseudocount
+		for taxaRank, norm_matrix in self.norm_count_tables.items():
+			cols = [self.phylo_tree.sampleIndex[self.samples['-'.join(col.split('_'))]] for col in norm_matrix.colNames]
+			rows = [self.phylo_tree.nodeByName[taxa] for taxa in norm_matrix.rowNames]
+			self.phylo_tree.normCounts[np.ix_(rows, cols)] = norm_matrix.data
+		self.rollup = Rollup(self.phylo_tree, self.conditions)
 		self.tree_norm_counts_populated = True
 
 	def getTaxaFromFilename(self,fname):
@@ -293,6 +257,26 @@ class IBotAnalysis(BaseIBotAnalysis):
 
 
 
+parsePhylogenyTreeVersion = 1
+
+def parsePhylogenyTree(filename, taxa_hierarchy, rootOffset):
+	phyloTree = Tree('ROOT', taxa_hierarchy, rootOffset)
+	with openMaybeZip(filename) as tF:
+		header = tF.readline()
+		for line in tF:
+			hierarchy = line.split('\t')
+			assert len(hierarchy) == 7
+			phyloTree.addPath([taxon.strip() for taxon in hierarchy])
+	return phyloTree
+
+
+def cleanNormCountHeader(head):
+	head = '_'.join(head.split('.'))
+	if '_count' in head:
+		head = head[:-6]
+	return head.strip().strip('"')
+
+
 class Sample(object):
 
 	def __init__(self,name,condition):
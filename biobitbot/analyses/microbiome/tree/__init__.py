@@ -1,3 +1,4 @@
 from __future__ import absolute_import
 
-from .tree import Tree, TreeNode
\ No newline at end of file
+from .tree import Tree, TreeNode, saveTree, loadTree
+from .rollup import Rollup
@@ -0,0 +1,88 @@
+"""
+Sums and means of a Tree's (node x sample) count matrices by sample and
+by condition, for every node and for every rank. Built once the counts
+are populated, so modules read aggregates from arrays instead of each
+walking the tree with dict lookups.
+"""
+
+import numpy as np
+
+
+class Rollup(object):
+
+	def __init__(self, tree, conditions):
+		"""
+		@parameter tree - a Tree with its samples set
+		@parameter conditions - dict of condition name to list of samples
+		"""
+		self.tree = tree
+		self.samples = tree.samples
+		self.sampleIndex = tree.sampleIndex
+		self.conditions = list(conditions.keys())
+		self.conditionIndex = {condition:c for c, condition in enumerate(self.conditions)}
+		self.ranks = list(tree.taxa_hierarchy)
+		self.rankIndex = {rank:r for r, rank in enumerate(self.ranks)}
+
+		# (sample x condition) indicator matrix
+		self.membership = np.zeros((len(self.samples), len(self.conditions)), dtype=np.int64)
+		for condition, samples in conditions.items():
+			for sample in samples:
+				self.membership[self.sampleIndex[sample], self.conditionIndex[condition]] = 1
+		self.conditionSizes = self.membership.sum(axis=0)
+		self.conditionColumns = {condition: np.flatnonzero(self.membership[:, c])
+									for condition, c in self.conditionIndex.items()}
+		self.rankNodes = [tree.rankIndices(rank) for rank in self.ranks]
+		self.measures = {}
+
+	def measure(self, name):
+		"""
+		Rollup of one of the tree's count matrices, built on first use
+		"""
+		if name not in self.measures:
+			self.measures[name] = MeasureRollup(self, getattr(self.tree, name))
+		return self.measures[name]
+
+	seqCounts = property(lambda self: self.measure('seqCounts'))
+	normCounts = property(lambda self: self.measure('normCounts'))
+	topAlignedSeqCounts = property(lambda self: self.measure('topAlignedSeqCounts'))
+
+	def sumByCondition(self, matrix):
+		"""
+		Sum the columns of a (x sample) matrix into a (x condition) matrix
+		"""
+		return np.dot(matrix, self.membership.astype(matrix.dtype))
+
+	def sumByRank(self, matrix):
+		"""
+		Sum the rows of a (node x) matrix into a (rank x) matrix
+		"""
+		return np.array([matrix[nodes].sum(axis=0) for nodes in self.rankNodes])
+
+	def groupByCondition(self, values):
+		"""
+		Split the columns of a (x sample) array into {condition: (x condition samples)}
+		"""
+		return {condition: values[..., cols] for condition, cols in self.conditionColumns.items()}
+
+
+class MeasureRollup(object):
+	"""
+	Aggregates of one (node x sample) matrix:
+
+	bySample             (node x sample) the matrix itself
+	byCondition          (node x condition) sums
+	meanByCondition      (node x condition) means
+	mean                 (node) mean over all samples
+	rankBySample         (rank x sample) sums over the nodes of each rank
+	rankByCondition      (rank x condition) sums
+	rankMeanByCondition  (rank x condition) means over each condition's samples
+	"""
+
+	def __init__(self, rollup, matrix):
+		self.bySample = matrix
+		self.byCondition = rollup.sumByCondition(matrix)
+		self.meanByCondition = self.byCondition / rollup.conditionSizes.astype(np.float64)
+		self.mean = matrix.mean(axis=1)
+		self.rankBySample = rollup.sumByRank(matrix)
+		self.rankByCondition = rollup.sumByCondition(self.rankBySample)
+		self.rankMeanByCondition = self.rankByCondition / rollup.conditionSizes.astype(np.float64)
@@ -1,113 +1,411 @@
+"""
+Phylogeny tree stored as flat arrays.
+
+Every node is an integer index. The tree keeps a parent index, a height
+and a rank for each node in numpy arrays, node names are interned in one
+list, and children are found through CSR offsets (built on demand). Read
+counts live in dense (node x sample) matrices rather than in one dict per
+node, so a taxonomy of 100k nodes and a few hundred samples is a handful
+of arrays instead of tens of millions of Python objects.
+
+TreeNode is a light view onto one index of a Tree, so code can still walk
+the tree node by node, but anything that touches every node should use
+the arrays directly.
+"""
+
+import os
+import numpy as np
+
+
+class SampleCounts(object):
+	"""
+	Dict-like view of one row of a (node x sample) matrix, keyed by sample
+	"""
+
+	def __init__(self, tree, matrixName, index):
+		self.tree = tree
+		self.matrixName = matrixName
+		self.index = index
+
+	def row(self):
+		return getattr(self.tree, self.matrixName)[self.index]
+
+	def __getitem__(self, sample):
+		return self.row()[self.tree.sampleIndex[sample]].item()
+
+	def __setitem__(self, sample, qty):
+		self.row()[self.tree.sampleIndex[sample]] = qty
+
+	def __contains__(self, sample):
+		return sample in self.tree.sampleIndex
+
+	def __len__(self):
+		return len(self.tree.samples)
+
+	def __iter__(self):
+		return iter(self.tree.samples)
+
+	def keys(self):
+		return list(self.tree.samples)
+
+	def values(self):
+		return self.row().tolist()
+
+	def items(self):
+		return zip(self.tree.samples, self.row().tolist())
+
+
 class TreeNode(object):
+	"""
+	View of one node of a Tree
+	"""
 
-	def __init__(self, name, parent):
-		self.name = name
-		self.parent = parent
-		self.children = {}
-		self.seqCountsBySamples = {}
-		self.normCountsBySamples = {}
-		self.height = 0
-		self.rfindheight(self.parent)
+	def __init__(self, tree, index):
+		self.tree = tree
+		self.index = index
 
-	def rfindheight(self,parent):
-		if parent != None:
-			self.height += 1
-			self.rfindheight(parent.parent) 
+	def __eq__(self, other):
+		return isinstance(other, TreeNode) and self.tree is other.tree and self.index == other.index
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash((id(self.tree), self.index))
+
+	@property
+	def name(self):
+		return self.tree.names[self.tree.nameIds[self.index]]
+
+	@property
+	def parent(self):
+		parent = self.tree.parents[self.index]
+		if parent < 0:
+			return None
+		return TreeNode(self.tree, parent)
+
+	@property
+	def height(self):
+		return int(self.tree.heights[self.index])
+
+	@property
+	def rank(self):
+		rankI = self.tree.ranks[self.index]
+		if rankI < 0:
+			return None
+		return self.tree.taxa_hierarchy[rankI]
+
+	@property
+	def children(self):
+		return {child.name: child for child in self}
 
 	def __iter__(self):
-		return iter(self.children.values())
+		for child in self.tree.childIndices(self.index):
+			yield TreeNode(self.tree, child)
 
 	def isleaf(self):
-		if self.children == None or len(self.children) == 0:
-			return True
-		return False
+		return len(self.tree.childIndices(self.index)) == 0
 
 	def addNameIfNotPresent(self, name):
-		if name not in self.children:
-			node = TreeNode(name, self)
-			self.children[name] = node
+		return TreeNode(self.tree, self.tree.addNode(name, self.index))
+
+	@property
+	def seqCountsBySamples(self):
+		return SampleCounts(self.tree, 'seqCounts', self.index)
+
+	@property
+	def normCountsBySamples(self):
+		return SampleCounts(self.tree, 'normCounts', self.index)
 
-		return self.children[name]
+	@property
+	def topAlignedSeqCountBySample(self):
+		return SampleCounts(self.tree, 'topAlignedSeqCounts', self.index)
 
 	def findSeqCountsThatDidNotAlignToChildren(self):
+		tree = self.tree
 		if self.name == 'NA' or self.height < 2:
-			self.topAlignedSeqCountBySample = {sample:0 for sample,qty in self.seqCountsBySamples.items()}
+			tree.topAlignedSeqCounts[self.index] = 0
 			return
 
-		childcount = {sample:0 for sample in self.seqCountsBySamples.keys()}
-		for child in self:
-			for sample, qty in child.seqCountsBySamples.items():
-				try:
-					childcount[sample] += qty
-				except KeyError:
-					print(self.name)
-					print(sample)
-					print childcount
-					print('---')
-					print self.seqCountsBySamples
-					assert False
-
-		self.topAlignedSeqCountBySample = {sample:qty for sample,qty in self.seqCountsBySamples.items()}
-		for sample, qty in childcount.items():
-			self.topAlignedSeqCountBySample[sample] -= qty
-
-		for qty in self.topAlignedSeqCountBySample.values():
-			try:
-				assert qty >= 0
-			except AssertionError:
-				print(self.name)
-				print(sample)
-				print(qty)
-				print('--- ')
-				for key,val in self.seqCountsBySamples.items():
-					print("{} : {}".format(key,val))
-				print('---')
-				for key,val in childcount.items():
-					print("{} : {}".format(key,val))
-				print('---')
-				for key,val in self.children.items():
-					print("{} : {}".format(key,val))
-				assert False
+		children = tree.childIndices(self.index)
+		top = tree.seqCounts[self.index] - tree.seqCounts[children].sum(axis=0)
+		assert (top >= 0).all(), "Children of {} have more reads than it does in samples {}".format(
+				self.name, ', '.join(str(tree.samples[j]) for j in np.flatnonzero(top < 0)))
+		tree.topAlignedSeqCounts[self.index] = top
+
+	def __str__(self):
+		return self.name
+
+
+class NodesByName(object):
+	"""
+	Dict-like view from node names to nodes. Where a name is used by
+	more than one node (eg. 'NA') the most recently added one is returned.
+	"""
+
+	def __init__(self, tree):
+		self.tree = tree
+
+	def __getitem__(self, name):
+		return TreeNode(self.tree, self.tree.nodeByName[name])
+
+	def __contains__(self, name):
+		return name in self.tree.nodeByName
+
+	def __len__(self):
+		return len(self.tree.nodeByName)
+
+	def __iter__(self):
+		return iter(self.tree.nodeByName)
+
+	def keys(self):
+		return self.tree.nodeByName.keys()
 
 
 class Tree(object):
 
-	def __init__(self, root, taxa_hierarchy):
-		self.root =root
-		self.all_nodes = {root.name:root}
-		self.taxa_hierarchy = taxa_hierarchy
-		self.size = 1
-		for node in self:
-			self.size += 1
-			self.all_nodes[node.name] = node
-		self.populateTaxa()
+	def __init__(self, rootName, taxa_hierarchy, rootOffset, capacity=1024):
+		"""
+		@parameter rootName - name of the root node
+		@parameter taxa_hierarchy - names of the ranks, highest first
+		@parameter rootOffset - height of the first rank from the root, the taxa_offset of the metadata
+		@parameter capacity - number of nodes to allocate space for up front
+		"""
+		self.taxa_hierarchy = list(taxa_hierarchy)
+		self.rootOffset = rootOffset
+		self.size = 0
 
+		# interned node names, nameIds holds an index into names for each node
+		self.names = []
+		self.nameIndex = {}
+		self.nodeByName = {}
+		self.childByName = {}
+		self.childOffsets = None
+		self.childOrder = None
+		self.taxaCache = None
+		self.preorderCache = None
 
-	def populateTaxa(self):
-		rootOffset = 2 # height of the first interesting rank (phylum) from the root
-		self.taxa = {rank:{} for rank in self.taxa_hierarchy}
-		for node in self:
-			rankI = node.height - rootOffset
-			if rankI < 0:
-				continue
-			rank = self.taxa_hierarchy[rankI]
-			self.taxa[rank][node.name] = node
+		self.samples = []
+		self.sampleIndex = {}
+
+		self.capacity = capacity
+		self._parents = np.empty(capacity, dtype=np.int32)
+		self._nameIds = np.empty(capacity, dtype=np.int32)
+		self._heights = np.empty(capacity, dtype=np.int16)
+		self._ranks = np.empty(capacity, dtype=np.int16)
+		self._seqCounts = None
+		self._normCounts = None
+		self._topAlignedSeqCounts = None
+
+		self.root = TreeNode(self, self.addNode(rootName, -1))
+
+	# Per node arrays, trimmed to the number of nodes in the tree
+	parents = property(lambda self: self._parents[:self.size])
+	nameIds = property(lambda self: self._nameIds[:self.size])
+	heights = property(lambda self: self._heights[:self.size])
+	ranks = property(lambda self: self._ranks[:self.size])
+	seqCounts = property(lambda self: self._seqCounts[:self.size])
+	normCounts = property(lambda self: self._normCounts[:self.size])
+	topAlignedSeqCounts = property(lambda self: self._topAlignedSeqCounts[:self.size])
+
+	def addNode(self, name, parent):
+		"""
+		Return the index of the child of parent called name, adding it if
+		it isn't there. A parent of -1 adds a root.
+		"""
+		try:
+			nameId = self.nameIndex[name]
+		except KeyError:
+			nameId = len(self.names)
+			self.names.append(name)
+			self.nameIndex[name] = nameId
+		if self.childByName is None:
+			self.childByName = dict(zip(zip(self.parents.tolist(), self.nameIds.tolist()), range(self.size)))
+		try:
+			return self.childByName[(parent, nameId)]
+		except KeyError:
+			pass
+
+		if self.size == self.capacity:
+			self.grow(2 * self.capacity)
+		node = self.size
+		self.size += 1
+		self._parents[node] = parent
+		self._nameIds[node] = nameId
+		height = 0 if parent < 0 else self._heights[parent] + 1
+		self._heights[node] = height
+		rankI = height - self.rootOffset
+		if rankI < 0 or rankI >= len(self.taxa_hierarchy):
+			rankI = -1
+		self._ranks[node] = rankI
+		self.childByName[(parent, nameId)] = node
+		self.nodeByName[name] = node
+		self.childOffsets = None
+		self.childOrder = None
+		self.taxaCache = None
+		self.preorderCache = None
+		return node
+
+	def addPath(self, names):
+		"""
+		Add a lineage of names below the root, highest rank first, and
+		return the index of the last node
+		"""
+		node = self.root.index
+		for name in names:
+			node = self.addNode(name, node)
+		return node
+
+	def grow(self, capacity):
+		def resized(arr, fill=0):
+			if arr is None:
+				return None
+			out = np.full((capacity,) + arr.shape[1:], fill, dtype=arr.dtype)
+			out[:self.size] = arr[:self.size]
+			return out
+		self._parents = resized(self._parents)
+		self._nameIds = resized(self._nameIds)
+		self._heights = resized(self._heights)
+		self._ranks = resized(self._ranks)
+		self._seqCounts = resized(self._seqCounts)
+		self._normCounts = resized(self._normCounts, self.pseudocount)
+		self._topAlignedSeqCounts = resized(self._topAlignedSeqCounts)
+		self.capacity = capacity
+
+	pseudocount = 0.000001
+
+	def setSamples(self, samples):
+		"""
+		Allocate the (node x sample) count matrices. Raw and top aligned
+		counts start at zero, normalised counts at a small pseudocount.
+		"""
+		self.samples = list(samples)
+		self.sampleIndex = {sample:j for j, sample in enumerate(self.samples)}
+		shape = (self.capacity, len(self.samples))
+		self._seqCounts = np.zeros(shape, dtype=np.int64)
+		self._normCounts = np.full(shape, self.pseudocount, dtype=np.float64)
+		self._topAlignedSeqCounts = np.zeros(shape, dtype=np.int64)
+
+	def buildChildren(self):
+		"""
+		Build CSR child lists: the children of node i are
+		childOrder[childOffsets[i]:childOffsets[i+1]], in the order they were added
+		"""
+		parents = self.parents
+		nonRoot = np.flatnonzero(parents >= 0)
+		counts = np.bincount(parents[nonRoot], minlength=self.size)
+		self.childOffsets = np.concatenate(([0], np.cumsum(counts)))
+		self.childOrder = nonRoot[np.argsort(parents[nonRoot], kind='mergesort')]
+
+	def childIndices(self, node):
+		if self.childOffsets is None:
+			self.buildChildren()
+		return self.childOrder[self.childOffsets[node]:self.childOffsets[node + 1]]
+
+	def childSums(self, matrix):
+		"""
+		Sum the rows of a (node x sample) matrix over the direct children
+		of every node at once. Leaves get zeros.
+		"""
+		if self.childOffsets is None:
+			self.buildChildren()
+		sums = np.zeros_like(matrix)
+		starts = self.childOffsets[:-1]
+		hasChildren = self.childOffsets[1:] > starts
+		if hasChildren.any():
+			sums[hasChildren] = np.add.reduceat(matrix[self.childOrder], starts[hasChildren], axis=0)
+		return sums
+
+	def findSeqCountsThatDidNotAlignToChildren(self):
+		"""
+		Set topAlignedSeqCounts for every node and sample in one pass: the
+		reads of a node less the reads of its children. Nodes named 'NA'
+		and nodes above the first rank get zero.
+
+		Raises a ValueError naming every node whose children hold more
+		reads than it does.
+		"""
+		top = self.seqCounts - self.childSums(self.seqCounts)
+		skip = self.heights < 2
+		if 'NA' in self.nameIndex:
+			skip |= self.nameIds == self.nameIndex['NA']
+		top[skip] = 0
+
+		badNodes, badSamples = np.nonzero(top < 0)
+		if len(badNodes) > 0:
+			bad = {}
+			for node, col in zip(badNodes.tolist(), badSamples.tolist()):
+				bad.setdefault(node, []).append(str(self.samples[col]))
+			msg = '; '.join('{} ({})'.format(self.names[self._nameIds[node]], ', '.join(samples))
+							for node, samples in sorted(bad.items()))
+			raise ValueError("Children have more reads than their parent in {} nodes: {}".format(len(bad), msg))
+
+		self.topAlignedSeqCounts[:] = top
+
+	def node(self, index):
+		return TreeNode(self, index)
+
+	@property
+	def all_nodes(self):
+		return NodesByName(self)
+
+	@property
+	def taxa(self):
+		"""
+		{rank: {name: node}} for every node at one of the ranks in taxa_hierarchy
+		"""
+		if self.taxaCache is None:
+			self.taxaCache = {}
+			for rank in self.taxa_hierarchy:
+				self.taxaCache[rank] = {node.name:node for node in self.iterRank(rank)}
+		return self.taxaCache
+
+	def __len__(self):
+		return self.size
+
+	def preorder(self):
+		"""
+		Indices of every node in pre-order (a node before its children,
+		children in the order they were added). Built with an explicit
+		stack and cached until the tree changes.
+		"""
+		if self.preorderCache is None:
+			if self.childOffsets is None:
+				self.buildChildren()
+			offsets = self.childOffsets.tolist()
+			childOrder = self.childOrder.tolist()
+			order = []
+			stack = [self.root.index]
+			while stack:
+				node = stack.pop()
+				order.append(node)
+				stack.extend(reversed(childOrder[offsets[node]:offsets[node + 1]]))
+			self.preorderCache = np.array(order, dtype=np.int32)
+		return self.preorderCache
+
+	def rankIndices(self, rank):
+		"""
+		Indices of the nodes at one rank of taxa_hierarchy, in pre-order
+		"""
+		order = self.preorder()
+		return order[self.ranks[order] == self.taxa_hierarchy.index(rank)]
+
+	def iterRank(self, rank):
+		for node in self.rankIndices(rank).tolist():
+			yield TreeNode(self, node)
 
 	def __iter__(self):
-		
-		def rIter( node):
-			if node.isleaf():
-				yield node
-			else:
-				yield node
-				for child in node:
-					for subchild in rIter(child):
-						yield subchild
-
-		for node in rIter(self.root):
-			yield node
-
-	def __get__(self,name):
+		for node in self.preorder().tolist():
+			yield TreeNode(self, node)
+
+	def __reversed__(self):
+		"""
+		Iterate every node after all of its descendants, for bottom up passes
+		"""
+		for node in self.preorder()[::-1].tolist():
+			yield TreeNode(self, node)
+
+	def __getitem__(self,name):
 		return self.all_nodes[name]
 
 	def __str__(self):
@@ -118,6 +416,51 @@ class Tree(object):
 			while rnode != None:
 				out += rnode.name + ";"
 				rnode = rnode.parent
-			mOut += out 
+			mOut += out
 			mOut += "\n"
-		return mOut
\ No newline at end of file
+		return mOut
+
+
+# Arrays saved by saveTree, in the order loadTree expects them
+treeArrays = ['parents', 'nameIds', 'heights', 'ranks', 'childOffsets', 'childOrder', 'preorder']
+
+def saveTree(tree, entryDir):
+	"""
+	Write the structure of a tree (not its counts) to entryDir as .npy
+	files, for biobitbot.utils.parse_cache. Returns the names and ranks.
+	"""
+	arrays = {
+		'parents': tree.parents,
+		'nameIds': tree.nameIds,
+		'heights': tree.heights,
+		'ranks': tree.ranks,
+		'preorder': tree.preorder(),
+		'childOffsets': tree.childOffsets,
+		'childOrder': tree.childOrder,
+	}
+	for name in treeArrays:
+		np.save(os.path.join(entryDir, '{}.npy'.format(name)), np.ascontiguousarray(arrays[name]))
+	return {'names': tree.names, 'taxa_hierarchy': tree.taxa_hierarchy, 'rootOffset': tree.rootOffset}
+
+def loadTree(entryDir, labels):
+	"""
+	Rebuild a tree saved by saveTree. The arrays are memory mapped read
+	only. Adding a node copies them first.
+	"""
+	arrays = {name: np.load(os.path.join(entryDir, '{}.npy'.format(name)), mmap_mode='r') for name in treeArrays}
+	names = labels['names']
+	tree = Tree(names[arrays['nameIds'][0]], labels['taxa_hierarchy'], labels['rootOffset'], capacity=1)
+	tree.size = tree.capacity = len(arrays['parents'])
+	tree._parents = arrays['parents']
+	tree._nameIds = arrays['nameIds']
+	tree._heights = arrays['heights']
+	tree._ranks = arrays['ranks']
+	tree.childOffsets = arrays['childOffsets']
+	tree.childOrder = arrays['childOrder']
+	tree.preorderCache = arrays['preorder']
+	tree.names = list(names)
+	tree.nameIndex = {name:i for i, name in enumerate(tree.names)}
+	tree.nodeByName = dict(zip([tree.names[i] for i in tree.nameIds.tolist()], range(tree.size)))
+	# only needed to add nodes, built by addNode when it is
+	tree.childByName = None
+	return tree
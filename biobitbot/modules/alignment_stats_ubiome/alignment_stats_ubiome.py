@@ -2,6 +2,7 @@ from biobitbot.modules.base_module import BaseIBotModule
 from biobitbot import plots
 from random import random
 import math
+import os
 from biobitbot.utils.utils import *
 
 
@@ -20,7 +21,7 @@ class IBotModule(BaseIBotModule):
 						</p>
 						"""
 
-	def buildChartSet(self, taxa_hierarchy, phylo_tree, samples, alignment_stat_files):
+	def buildChartSet(self, taxa_hierarchy, rollup, samples, alignment_stat_files):
 
 		alignStats = {}
 		for alignStatF in alignment_stat_files:
@@ -31,11 +32,13 @@ class IBotModule(BaseIBotModule):
 			else:
 				alignStats[sample][1][taxa] = alignedReads
 
+		# Reads aligned no lower than each rank, summed over the rank's nodes
+		topAlignedByRank = rollup.topAlignedSeqCounts.rankBySample
+
 		plotData = {}
 		for sample, (totalReads, stats) in alignStats.items():
 			for taxa in taxa_hierarchy:
-				nodes = phylo_tree.taxa[taxa].values()
-				topAligned = sum([node.topAlignedSeqCountBySample[sample] for node in nodes])
+				topAligned = topAlignedByRank[rollup.rankIndex[taxa], rollup.sampleIndex[sample]].item()
 
 				if sample.name not in plotData:
 					plotData[sample.name] = {}
@@ -69,7 +72,7 @@ def getAlignmentStats(fname):
 		taxa = 'gene'
 	else:
 		taxa = fn.split('.')[1]
-	with openMaybeZip(fname['fn']) as f:
+	with openMaybeZip(os.path.join(fname['root'], fname['fn'])) as f:
 		f.readline()
 		totalReads, alignedReads, _ = f.readline().split()
 		return (sampleName, taxa, int(totalReads), int(alignedReads))
\ No newline at end of file
@@ -1,6 +1,7 @@
 from biobitbot.modules.base_module import BaseIBotModule
 from random import random
 import math
+import os
 import biobitbot.plots.boxplot as boxplot
 from biobitbot.utils.utils import *
 
@@ -25,7 +26,7 @@ class IBotModule(BaseIBotModule):
 		for dfile in diversity_files:
 			for taxa in taxa_hierarchy:
 				if taxa in dfile['fn']:
-					with openMaybeZip(dfile['fn']) as df:
+					with openMaybeZip(os.path.join(dfile['root'], dfile['fn'])) as df:
 						df.readline()
 						for line in df:
 							sampleName, sInd = line.split()
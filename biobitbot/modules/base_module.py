@@ -6,7 +6,8 @@ BioBitBot module base class.
 Modules provide the raw html necessary to create a report.
 
 Modules can provide html either appended to the self.intro variable
-or as a dictionary in the self.sections list.
+or as a section added with self.add_section. Both are spooled to a
+temporary file (see report.SpooledHtml) rather than kept in memory.
 
 Modules take in parsed data (from their parent analysis) do light
 data analysis and make calls to plotting functions.
@@ -35,11 +36,21 @@ class BaseIBotModule(object):
         self.anchor = anchor
         if not target:
             target = self.name
-        self.intro = '<p><a href="{0}" target="_blank">{1}</a> {2}</p>{3}'.format(
+        self.intro = report.SpooledHtml('<p><a href="{0}" target="_blank">{1}</a> {2}</p>{3}'.format(
             href, target, info, extra
-        )
+        ))
         self.sections = []
 
+    def add_section(self, name, anchor, content):
+        """
+        Add a section to the module's output, with its content spooled
+        """
+        self.sections.append({
+            'name': name,
+            'anchor': anchor,
+            'content': report.SpooledHtml(content)
+        })
+
     def split_over_columns(self, els, rowwise=False):
         """
         Given a list of lists of strings containing html 
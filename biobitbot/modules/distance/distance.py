@@ -1,6 +1,12 @@
 from biobitbot.modules.base_module import BaseIBotModule
+from biobitbot.utils import config
 import itertools
 import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy as np
 import biobitbot.plots.boxplot as boxplot
 
 class IBotModule(BaseIBotModule):
@@ -18,44 +24,31 @@ class IBotModule(BaseIBotModule):
 						</p>
 						"""
 
-	def buildChartSet(self,table,conditions,idcol='ids'):
+	def buildChartSet(self,matrix,conditions):
 		metrics = [
-					(JSD,'jensen-shannon distance'),
-					(COS,'cosine similarity'),
+					(pairwiseJSD,'jensen-shannon distance'),
+					(pairwiseCOS,'cosine similarity'),
 					]
 		for metric, metricName in metrics:
-			chart = oneChart(metricName,table,conditions,metric,idcol)
-			self.sections.append({
-				'name' : metricName.title(),
-				'anchor' : 'distance_{}'.format(metricName),
-				'content' : chart
-				})
-
-def oneChart(metricName, table,conditions,metric,idcol):
-	cols, rows = table.getTable()
-	samples = [col.name for col in cols if idcol not in col.name]
-	norm_sample = {sample:[] for sample in samples}
-	for row in rows:
-		for i,col in enumerate(cols):
-			if col.name == idcol:
-				continue
-			norm_sample[col.name].append(row[i])
-
-	distTable = { sample : {sample:1 for sample in samples} for sample in samples}
-	for s1, s2 in itertools.combinations(samples,2):
-		distance = metric(norm_sample[s1], norm_sample[s2])
-		distTable[s1][s2] = distance
-		distTable[s2][s1] = distance
+			chart = oneChart(metricName,matrix,conditions,metric)
+			self.add_section(metricName.title(), 'distance_{}'.format(metricName), chart)
+
+def oneChart(metricName, matrix,conditions,metric):
+	samples = matrix.colNames
+	distMatrix = metric(np.asarray(matrix.data, dtype=np.float64).T)
+	# Matrix indices of each condition's samples, so the distances of a
+	# pair of conditions are one block of the matrix
+	conditionIndices = {}
+	for condition in conditions:
+		conditionIndices[condition] = np.array([i for i, sample in enumerate(samples)
+												if condition in getConditionsFromName(sample,conditions)], dtype=np.int64)
 
 	plotData = []
 	for condition in conditions:
-		matchingSamples = []
-		for sample in samples:
-			if condition in getConditionsFromName(sample,conditions):
-				matchingSamples.append(sample)
-		distances = []
-		for s1, s2 in itertools.combinations(matchingSamples,2):	
-			distances.append( distTable[s1][s2])
+		idx = conditionIndices[condition]
+		# Each pair of samples once, in the order of itertools.combinations
+		within = distMatrix[np.ix_(idx, idx)]
+		distances = within[np.triu_indices(len(idx), 1)].tolist()
 		distribution = [
 					"{}".format(condition),
 					min(distances),
@@ -67,18 +60,7 @@ def oneChart(metricName, table,conditions,metric,idcol):
 		plotData.append(distribution)
 
 	for c1,c2 in itertools.combinations(conditions,2):
-		matchingSamples1 = []
-		for sample in samples:
-			if c1 in getConditionsFromName(sample,conditions):
-				matchingSamples1.append(sample)
-		matchingSamples2 = []
-		for sample in samples:
-			if c2 in getConditionsFromName(sample,conditions):
-				matchingSamples2.append(sample)
-		distances = []
-		for s1 in matchingSamples1:
-			for s2 in matchingSamples2:
-				distances.append( distTable[s1][s2])
+		distances = distMatrix[np.ix_(conditionIndices[c1], conditionIndices[c2])].ravel().tolist()
 		distribution = [
 					"{} {}".format(c1,c2),
 					min(distances),
@@ -100,6 +82,137 @@ def oneChart(metricName, table,conditions,metric,idcol):
 	plot += bPlot
 	return plot
 
+def tileSize(nfeatures, nbytes):
+	"""
+	Number of samples per side of a square tile of pairs so that a
+	(tile x tile x features) float64 block fits in nbytes
+	"""
+	return max(1, int(math.sqrt(nbytes / (8.0 * max(1, nfeatures)))))
+
+def pairwiseCOS(X, tileBytes=None, threads=None):
+	"""
+	Cosine similarity between every pair of rows of X (samples x features).
+	Rows are normalised once and similarities come from one matrix product
+	per block of rows. Gives the same values as COS.
+	"""
+	if tileBytes is None:
+		tileBytes = config.distance_tile_bytes
+	n = X.shape[0]
+	Xn = X / np.sqrt((X * X).sum(axis=1))[:, None]
+	block = max(1, int(tileBytes / (8.0 * max(1, n))))
+	return computeRowBlocks('cos', {'Xn': Xn}, n, block, threads)
+
+def pairwiseJSD(X, tileBytes=None, eps=0.000001, threads=None):
+	"""
+	Jensen-Shannon distance between every pair of rows of X (samples x features).
+	Rows are normalised once. The mixture distribution has to be built for
+	every pair, so pairs are computed in square tiles sized to keep each
+	(tile x tile x features) block under tileBytes. Gives the same values
+	as JSD, including its pseudocount.
+	"""
+	if tileBytes is None:
+		tileBytes = config.distance_tile_bytes
+	n, m = X.shape
+	P = X / X.sum(axis=1)[:, None]
+	# sum((p+eps) * log(p+eps)) for each sample, the part of KLD(P,M) that doesn't depend on M
+	Pe = P + eps
+	H = (Pe * np.log(Pe)).sum(axis=1)
+	block = tileSize(m, tileBytes)
+	out = computeRowBlocks('jsd', {'P': P, 'H': H, 'eps': np.array([eps])}, n, block, threads)
+	# Only tiles on or above the diagonal were computed
+	lower = np.tril_indices(n, -1)
+	out[lower] = out.T[lower]
+	return out
+
+def jsdTile(P, H, i0, i1, j0, j1, eps=0.000001):
+	"""
+	Jensen-Shannon distances between rows i0:i1 and rows j0:j1 of the
+	normalised matrix P, given H = sum((p+eps) * log(p+eps)) for each row
+	"""
+	A = P[i0:i1, None, :]
+	B = P[None, j0:j1, :]
+	logM = np.log(0.5 * (A + B) + eps)
+	cross = ((A + eps) * logM).sum(axis=2) + ((B + eps) * logM).sum(axis=2)
+	div = 0.5 * (H[i0:i1, None] + H[None, j0:j1] - cross)
+	return np.sqrt(np.maximum(div, 0))
+
+def jsdRowBlock(inputs, out, i0, i1, block):
+	P, H, eps = inputs['P'], inputs['H'], float(inputs['eps'][0])
+	n = P.shape[0]
+	for j0 in range(i0, n, block):
+		j1 = min(n, j0 + block)
+		out[i0:i1, j0:j1] = jsdTile(P, H, i0, i1, j0, j1, eps)
+
+def cosRowBlock(inputs, out, i0, i1, block):
+	Xn = inputs['Xn']
+	out[i0:i1] = np.dot(Xn[i0:i1], Xn.T)
+
+rowBlockFuncs = {
+	'jsd' : jsdRowBlock,
+	'cos' : cosRowBlock,
+}
+
+def computeRowBlocks(metric, inputs, n, block, threads=None):
+	"""
+	Fill an n x n distance matrix one block of rows at a time with
+	rowBlockFuncs[metric]. With more than one thread the blocks are shared
+	out to a process pool. The inputs and the output are written to .npy
+	files which every worker memory maps, so no arrays are pickled between
+	processes. Each worker holds one tile at a time, so peak memory is
+	about threads x config.distance_tile_bytes.
+	"""
+	if threads is None:
+		threads = config.threads
+	blocks = [(i0, min(n, i0 + block)) for i0 in range(0, n, block)]
+	rowBlock = rowBlockFuncs[metric]
+
+	if threads <= 1 or len(blocks) <= 1:
+		out = np.zeros((n, n))
+		for i0, i1 in blocks:
+			rowBlock(inputs, out, i0, i1, block)
+		return out
+
+	tmpDir = tempfile.mkdtemp(prefix='biobitbot_distance_')
+	try:
+		inputFns = {}
+		for name, arr in inputs.items():
+			inputFns[name] = os.path.join(tmpDir, '{}.npy'.format(name))
+			np.save(inputFns[name], np.ascontiguousarray(arr))
+		outFn = os.path.join(tmpDir, 'out.npy')
+		out = np.lib.format.open_memmap(outFn, mode='w+', dtype=np.float64, shape=(n, n))
+		del out
+
+		pool = multiprocessing.Pool(min(threads, len(blocks)),
+									initializer=initRowBlockWorker,
+									initargs=(inputFns, outFn))
+		try:
+			# Blocks near the top of an upper triangle are the biggest, start them first
+			for _ in pool.imap_unordered(rowBlockWorker, [(metric, i0, i1, block) for i0, i1 in blocks]):
+				pass
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+		return np.array(np.load(outFn, mmap_mode='r'))
+	finally:
+		shutil.rmtree(tmpDir, ignore_errors=True)
+
+# Memory mapped inputs and output of the current worker process
+workerArrays = {}
+
+def initRowBlockWorker(inputFns, outFn):
+	workerArrays['inputs'] = {name: np.load(fn, mmap_mode='r') for name, fn in inputFns.items()}
+	workerArrays['out'] = np.load(outFn, mmap_mode='r+')
+
+def rowBlockWorker(args):
+	metric, i0, i1, block = args
+	out = workerArrays['out']
+	rowBlockFuncs[metric](workerArrays['inputs'], out, i0, i1, block)
+	out.flush()
+	return i0
+
 def COS(A,B):
 	assert len(A) == len(B)
 	magA = math.sqrt( sum([el*el for el in A]))
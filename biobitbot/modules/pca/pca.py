@@ -59,7 +59,8 @@ class IBotModule(BaseIBotModule):
 												'ylab':'PC{} ({:.1f}%)'.format(j+1,100*axes[j]), 
 												'xlab':'PC{} ({:.1f}%)'.format(i+1,100*axes[i]), 
 												'title':'Principal Components {} and {}'.format(i+1,j+1),
-												'legend': True
+												'legend': True,
+												'pack_data': True
 												})
 			plots.append(plot)	
 
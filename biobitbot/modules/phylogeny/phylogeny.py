@@ -1,9 +1,13 @@
 import biobitbot.plots.treemap as treemap
 from biobitbot.modules.base_module import BaseIBotModule
+from biobitbot.utils import config, report
 from random import random
+import logging
 import math
 from biobitbot.utils.utils import *
 
+logger = logging.getLogger(__name__)
+
 class IBotModule(BaseIBotModule):
 
 	def __init__(self):
@@ -20,67 +24,118 @@ class IBotModule(BaseIBotModule):
 						</p>
 						"""
 
-	def buildChartSet(self, conditions, phylo_tree,taxa_hierarchy,root_offset):
-		for condition, samples in conditions.items():
-			tMap = self.oneTreemap(samples, phylo_tree.root, condition,taxa_hierarchy,root_offset)
-			self.sections.append({
-				'name' : '{} Tree Map'.format(condition.title()),
-				'anchor' : '{}_tree_map'.format(condition),
-				'content' : tMap
-				})
-
-
-	def oneTreemap(self, samples, rootnode, condition,taxa_hierarchy,root_offset):
-
-		def rMakeDict(node, getter,compGetter):
-			if node.isleaf():
-				val = getter(node)
-				compval = compGetter(node)
-				if val < 2 and compval < 2:
-					return None
-				name = node.name
-				if name == 'NA':
-					name = 'Unknown_{}'.format(taxa_hierarchy[-1])
-				return node.name, val, compval
-			out = {}
-			comparator = {}
-			for child in node:
-				rout = rMakeDict(child,getter, compGetter)
-				if rout == None:
-					continue
-				cname, val, compval = rout
-				out[cname] = val
-				comparator[cname] = compval
-			out['size'] = getter(node)
-			comparator['size'] = compGetter(node)
-			if len(out) == 0:
-				return None
+	def buildChartSet(self, conditions, phylo_tree, rollup, taxa_hierarchy):
+		"""
+		One treemap per condition. The pruned tree and the comparator (mean
+		over all samples) are emitted once and shared by every condition's
+		treemap, which only carries its own values.
+		"""
+		conditionNames = list(conditions.keys())
+		cols = [rollup.conditionIndex[condition] for condition in conditionNames]
+		means = rollup.normCounts.meanByCondition[:, cols].tolist()
+		overallMeans = rollup.normCounts.mean.tolist()
+		# Total abundance at each rank, to prune nodes by relative abundance
+		rankTotals = rollup.normCounts.rankMeanByCondition[:, cols].tolist()
+		compRankTotals = rollup.normCounts.rankBySample.mean(axis=1).tolist()
+
+		parents, names, values, comparator = self.treemapSkeleton(phylo_tree, means, overallMeans, rankTotals,
+													compRankTotals, taxa_hierarchy, True)
+		skeletonId = 'phylogeny_treemap_skeleton'
+		# Serialised size of the plot data, as registered with the report's datasets
+		bytesBefore = report.dataset_stats['bytes_in']
+		self.intro += treemap.plot_skeleton(skeletonId, parents, names, comparator)
+
+		for c, condition in enumerate(conditionNames):
+			pconfig = {
+						'id':'phylogeny_treemap_{}'.format(condition),
+						'title':'Phylogeny Tree {}'.format(condition),
+						'subtitle':'Full'
+						}
+			tMap = treemap.plot_values(skeletonId, [val[c] for val in values], pconfig=pconfig)
+			self.add_section('{} Tree Map'.format(condition.title()), '{}_tree_map'.format(condition), tMap)
+
+		# The root isn't drawn
+		logger.info("Phylogeny treemaps: {} nodes after pruning a tree of {}, {:.1f} kB of plot data".format(
+					len(names), phylo_tree.size - 1, (report.dataset_stats['bytes_in'] - bytesBefore) / 1000.0))
+
+
+	def treemapSkeleton(self, phylo_tree, means, overallMeans, rankTotals, compRankTotals, taxa_hierarchy, prune):
+		"""
+		Flatten the tree in pre-order into (parents, names, values, comparator),
+		where values holds the mean of each node in every condition.
+
+		Children are kept if they are abundant in any condition or overall.
+		The rest are folded into one 'Other <rank>' node holding their summed
+		abundance, so totals are preserved.
+		"""
+		parents = []
+		names = []
+		values = []
+		comparator = []
+		rootOffset = phylo_tree.rootOffset
+
+		def nodeName(node):
 			name = node.name
 			if name == 'NA':
-				rankI = node.height - root_offset
+				rankI = node.height - rootOffset
 				if rankI < 0:
 					name ='Unknown_High_Taxon'
 				elif rankI > len(taxa_hierarchy) - 1 :
 					name = 'Unknown_Low_Taxon'
 				else:
-					name = 'Unknown_{}'.format(taxa_hierarchy[rankI])	
-
-			return name, out, comparator
-
-		def getter(node):
-			numerator = 0
-			for sample in samples:
-				numerator += node.normCountsBySamples[sample]
-			denominator = len(samples)
-			return numerator / denominator
-
-		comparatorgetter = lambda n: sum(n.normCountsBySamples.values())/len(n.normCountsBySamples)
-		root, treeAsDict, compTree = rMakeDict(rootnode, getter, comparatorgetter)
-		# treeAsDict = treeAsDict['Bacteria']['Firmicutes']['Clostridia']['Clostridiales']['Clostridiaceae']
-		# compTree = compTree['Bacteria']['Firmicutes']['Clostridia']['Clostridiales']['Clostridiaceae']
-		pconfig = {
-					'id':'phylogeny_treemap_{}'.format(condition),
-					'title':'Phylogeny Tree {}'.format(condition),
-					'subtitle':'Full'
-					}
-		return treemap.plot((treeAsDict,compTree),pconfig=pconfig)
\ No newline at end of file
+					name = 'Unknown_{}'.format(taxa_hierarchy[rankI])
+			return name
+
+		def foldChildren(children, rankI):
+			rank = None
+			if 0 <= rankI < len(taxa_hierarchy):
+				rank = taxa_hierarchy[rankI]
+
+			# Leaves that are tiny everywhere are always folded
+			small = lambda n: n.isleaf() and max(means[n.index]) < 2 and overallMeans[n.index] < 2
+			folded = [n for n in children if small(n)]
+			kept = [n for n in children if not small(n)]
+			if prune and rank is not None:
+				maxChildren = rankLimit(config.treemap_max_children, rank)
+				minAbundance = rankLimit(config.treemap_min_relative_abundance, rank) or 0
+				totals = rankTotals[rankI]
+				def abundance(n):
+					rel = [val / total for val, total in zip(means[n.index], totals)]
+					return max(rel + [overallMeans[n.index] / compRankTotals[rankI]])
+				candidates = sorted(kept, key=abundance, reverse=True)
+				kept = []
+				for n in candidates:
+					if (maxChildren is None or len(kept) < maxChildren) and abundance(n) >= minAbundance:
+						kept.append(n)
+					else:
+						folded.append(n)
+			return rank, kept, folded
+
+		def addPoint(parent, name, vals, compval):
+			parents.append(parent)
+			names.append(name)
+			values.append(vals)
+			comparator.append(compval)
+			return len(names) - 1
+
+		def rAdd(node, parent):
+			rank, kept, folded = foldChildren(list(node), node.height + 1 - rootOffset)
+			for child in kept:
+				pos = addPoint(parent, nodeName(child), means[child.index], overallMeans[child.index])
+				rAdd(child, pos)
+			if len(folded) > 0:
+				otherVals = [sum(vals) for vals in zip(*[means[n.index] for n in folded])]
+				otherCompval = sum(overallMeans[n.index] for n in folded)
+				addPoint(parent, 'Other {}'.format(rank or 'taxa'), otherVals, otherCompval)
+
+		rAdd(phylo_tree.root, -1)
+		return parents, names, values, comparator
+
+
+def rankLimit(setting, rank):
+	"""
+	Pruning settings are either one value for every rank or a dict of values by rank
+	"""
+	if isinstance(setting, dict):
+		return setting.get(rank)
+	return setting
@@ -0,0 +1,92 @@
+"""
+Deterministic downsampling of scatter plot points.
+
+Points are binned on a square grid over their extent. Every point in a
+sparse bin is kept, as are the points with the smallest and largest x
+and y in every bin, so the outline of the cloud and its outliers
+survive. The rest of the budget is filled with a seeded uniform sample
+of the remaining points, which keeps the density of the cloud. The
+same input always gives the same output.
+"""
+
+import numpy as np
+
+# Bins holding at most this many points are kept whole
+sparseBinSize = 8
+
+
+def gridSizeFor(maxPoints):
+	"""
+	Grid size such that the points kept for sparse bins and bin extremes
+	fill at most half of maxPoints
+	"""
+	return max(1, int(np.sqrt(maxPoints / (2.0 * sparseBinSize))))
+
+
+def binIndex(vals, gridSize):
+	lo = vals.min()
+	span = vals.max() - lo
+	if span <= 0:
+		return np.zeros(len(vals), dtype=np.int64)
+	bins = ((vals - lo) / span * gridSize).astype(np.int64)
+	return np.minimum(bins, gridSize - 1)
+
+
+def downsample(xs, ys, maxPoints, seed=0):
+	"""
+	Choose at most maxPoints of the points (xs[i], ys[i])
+
+	@return - sorted numpy array of the indices of the points to keep
+	"""
+	n = len(xs)
+	if n <= maxPoints:
+		return np.arange(n)
+	if maxPoints <= 0:
+		return np.arange(0)
+	xs = np.asarray(xs, dtype=np.float64)
+	ys = np.asarray(ys, dtype=np.float64)
+	gridSize = gridSizeFor(maxPoints)
+	bins = binIndex(xs, gridSize) * gridSize + binIndex(ys, gridSize)
+
+	keep = np.bincount(bins, minlength=gridSize * gridSize)[bins] <= sparseBinSize
+	for vals in (xs, ys):
+		# sort by bin then value, the first and last point of each bin are its extremes
+		order = np.lexsort((vals, bins))
+		sortedBins = bins[order]
+		firsts = np.flatnonzero(np.r_[True, sortedBins[1:] != sortedBins[:-1]])
+		lasts = np.r_[firsts[1:], n] - 1
+		keep[order[firsts]] = True
+		keep[order[lasts]] = True
+
+	rng = np.random.RandomState(seed)
+	kept = np.flatnonzero(keep)
+	if len(kept) >= maxPoints:
+		chosen = rng.choice(kept, maxPoints, replace=False)
+	else:
+		rest = np.flatnonzero(~keep)
+		chosen = np.concatenate((kept, rng.choice(rest, maxPoints - len(kept), replace=False)))
+	return np.sort(chosen)
+
+
+def splitBudget(nSignificant, nBackground, maxPoints):
+	"""
+	Share maxPoints between significant and background points. Significant
+	points get priority, but at least a quarter of the budget is kept for
+	the background if it needs it.
+	"""
+	if nSignificant + nBackground <= maxPoints:
+		return nSignificant, nBackground
+	background = min(nBackground, max(maxPoints - nSignificant, maxPoints // 4))
+	return min(nSignificant, maxPoints - background), background
+
+
+def thinPoints(points, xy, maxPoints, seed=0):
+	"""
+	Downsample a list of points to at most maxPoints, keeping their order
+
+	@parameter xy - function giving the (x, y) position of a point
+	"""
+	if len(points) <= maxPoints:
+		return points
+	xs, ys = zip(*[xy(point) for point in points])
+	return [points[i] for i in downsample(xs, ys, maxPoints, seed).tolist()]
@@ -1,8 +1,16 @@
 from biobitbot.modules.base_module import BaseIBotModule
-from random import random
+from biobitbot.modules.significance.downsample import splitBudget, thinPoints
+from biobitbot.utils import config
 import math
+import re
 import biobitbot.plots.scatterplot as scatter
 
+significantWhere = "abs(logFC) > ? AND adj_P_Val < ?"
+
+# Background points are sampled in SQL to about this many times a plot's
+# point budget before the grid downsampler chooses the ones to draw
+backgroundOversample = 4
+
 
 
 
@@ -26,177 +34,169 @@ If a point is upregulated in the first condition this is considered a positive l
 		if strict == 0:
 			minLfc=0.5
 			maxApv=0.1
-			rarefier=0.1
 		elif strict == 1:
 			minLfc=0.75
 			maxApv=0.05
-			rarefier=0.05
 		elif strict == 2:
 			minLfc=1
 			maxApv=0.01
-			rarefier=0.01
 		else:
 			minLfc=1
 			maxApv=0.001
-			rarefier=0.005
-		return minLfc, maxApv, rarefier
+		maxPoints = config.significance_max_points.get(strict, min(config.significance_max_points.values()))
+		return minLfc, maxApv, maxPoints
 
 	def buildChartSet(self, name, table, idcol='ids',groups=None,strict=1):
 
-		minLfc, maxApv, rarefier = self.strictness(strict)
+		minLfc, maxApv, maxPoints = self.strictness(strict)
+		indexDiffTable(table)
 		if groups == None:
-
-			v = volcanoMultiGroup(table,name,idcol,minLfc,maxApv,rarefier)
-			m = maMultiGroup(table,name,idcol,minLfc,maxApv,rarefier)
+			volcanoTitle = '{} Volcano Plot'.format(name)
+			maTitle = '{} MA Plot'.format(name)
 		else:
 			assert len(groups) == 2
-			v = volcano(table,groups,idcol,minLfc,maxApv,rarefier)
-			m = ma(table,groups,idcol,minLfc,maxApv,rarefier)
+			volcanoTitle = 'Volcano Plot {} v. {}'.format(*groups)
+			maTitle = 'MA Plot {} v. {}'.format(*groups)
+
+		v, m = volcanoAndMa(table, volcanoTitle, maTitle, idcol, minLfc, maxApv, maxPoints, grouped=groups == None)
 
 		plot = self.split_over_columns([[v,m]],rowwise=True)
 
-		self.sections.append({
-			'name' : name,
-			'anchor' : 'sig_plots_{}'.format(name),
-			'content' : plot
-			})
-
-
-
-def volcano(table,groups,idcol,minLfc,maxApv,rarefier):
-	cols, rows = table.getTable(sqlCmd="SELECT {}, logFC, adj_P_Val FROM {{table_name}} ".format(idcol))
-	xmin = False
-	xmax = False
-	ymin = False
-	ymax = False
-	lava = {'not significant (rarefied)':[], 'significant':[]}
-	for gene, lfc, apv in rows:
-		yval = -math.log(apv,2)
-		if abs(lfc) > minLfc and apv < maxApv:
-			lava['significant'].append({'name':gene, 'x':lfc, 'y':yval})
-		elif random() <  rarefier: # rarify insignificant points so page loads faster 
-			lava['not significant (rarefied)'].append([lfc,yval])
-		if not xmax or lfc > xmax:
-			xmax = lfc
-		elif not xmin or lfc < xmin:
-			xmin = lfc
-		if not ymax or yval > ymax:
-			ymax = yval
-		elif not ymin or yval < ymin:
-			ymin = yval
-
-	return scatter.plot(lava, pconfig={
-										'ylab':'Negative log of adjusted p value', 
-										'xlab':'average log fold change', 
-										'title':'Volcano Plot {} v. {}'.format(*groups),
-										'legend':True,
-										'xmax':xmax,
-										'xmin':xmin,
-										'ymax':ymax,
-										'ymin':ymin,
-										})
-
-def ma(table,groups,idcol,minLfc,maxApv,rarefier):
-	cols, rows = table.getTable(sqlCmd="SELECT {}, logFC, adj_P_Val, AveExpr FROM {{table_name}} ".format(idcol))
-	xmin = False
-	xmax = False
-	ymin = False
-	ymax = False
-	lava = {'not significant (rarefied)':[], 'significant':[]}
-	for  gene, lfc, apv, aE in rows:
-		if abs(lfc) > minLfc and apv < maxApv:
-			lava['significant'].append({'name':gene, 'y':lfc, 'x':aE})
-		elif random() <  rarefier: # rarify insignificant points so page loads faster 
-			lava['not significant (rarefied)'].append([aE,lfc])
-		if not xmax or aE > xmax:
-			xmax = aE
-		elif not xmin or aE < xmin:
-			xmin = aE
-		if not ymax or lfc > ymax:
-			ymax = lfc
-		elif not ymin or lfc < ymin:
-			ymin = lfc
-
-	return scatter.plot(lava, pconfig={
-										'ylab':'Ave. Log Fold Change', 
-										'xlab':'Ave. Expression', 
-										'title':'MA Plot {} v. {}'.format(*groups),
-										'legend':True,
-										'xmax':xmax,
-										'xmin':xmin,
-										'ymax':ymax,
-										'ymin':ymin,
-
-										})
-
-def volcanoMultiGroup(table,name,idcol,minLfc,maxApv,rarefier):
-	cols, rows = table.getTable(sqlCmd="SELECT {}, logFC, adj_P_Val, group1, group2 FROM {{table_name}} ".format(idcol))
-	xmin = False
-	xmax = False
-	ymin = False
-	ymax = False
-
-	lava = {'not significant (rarefied)':[]}
-	for taxa, lfc, apv, g1, g2 in rows:
-		group = "{} {}".format(g1,g2)
-		yval = -math.log(apv,2)
-		if abs(lfc) > minLfc and apv < maxApv:
-			if group not in lava:
-				lava[group] = []
-			lava[group].append({'name':taxa, 'x':lfc, 'y':yval})
-		elif random() <  rarefier: # rarify insignificant points so page loads faster 
-			lava['not significant (rarefied)'].append([lfc,yval])
-		if not xmax or lfc > xmax:
-			xmax = lfc
-		elif not xmin or lfc < xmin:
-			xmin = lfc
-		if not ymax or yval > ymax:
-			ymax = yval
-		elif not ymin or yval < ymin:
-			ymin = yval
-
-	return scatter.plot(lava, pconfig={
-										'ylab':'Negative log of adjusted p value', 
-										'xlab':'average log fold change', 
-										'title':'{} Volcano Plot'.format(name),
-										'legend':True,
-										'xmax':xmax,
-										'xmin':xmin,
-										'ymax':ymax,
-										'ymin':ymin,
-										})
-
-def maMultiGroup(table,taxaLvl,idcol,minLfc,maxApv,rarefier):
-	cols, rows = table.getTable(sqlCmd="SELECT {}, logFC, adj_P_Val, AveExpr, group1, group2 FROM {{table_name}} ".format(idcol))
-	xmin = False
-	xmax = False
-	ymin = False
-	ymax = False
-	lava = {'not significant (rarefied)':[]}
-	for  taxa, lfc, apv, aE, g1, g2 in rows:
-		group = "{} {}".format(g1,g2)
-		if abs(lfc) > minLfc and apv < maxApv:
-			if group not in lava:
-				lava[group] = []
-			lava[group].append({'name':taxa, 'y':lfc, 'x':aE})
-		elif random() <  rarefier: # rarify insignificant points so page loads faster 
-			lava['not significant (rarefied)'].append([aE,lfc])
-		if not xmax or aE > xmax:
-			xmax = aE
-		elif not xmin or aE < xmin:
-			xmin = aE
-		if not ymax or lfc > ymax:
-			ymax = lfc
-		elif not ymin or lfc < ymin:
-			ymin = lfc
-
-	return scatter.plot(lava, pconfig={
-										'ylab':'Ave. Log Fold Change', 
-										'xlab':'Ave. Expression', 
-										'title':'{} MA Plot'.format(taxaLvl),
-										'legend':True,
-										'xmax':xmax,
-										'xmin':xmin,
-										'ymax':ymax,
-										'ymin':ymin,
-										})
+		self.add_section(name, 'sig_plots_{}'.format(name), plot)
+
+	def buildRankChartSets(self, tables, ranks, idcol='taxa', strict=1):
+		"""
+		Charts for the diff tables of every taxonomic rank in one call
+
+		@parameter tables - dict of rank to the SqlDataTable of its diff counts
+		@parameter ranks - the ranks to chart, in the order of their sections
+		"""
+		for rank in ranks:
+			self.buildChartSet(rank.title(), tables[rank], idcol=idcol, groups=None, strict=strict)
+
+
+
+def volcanoAndMa(table, volcanoTitle, maTitle, idcol, minLfc, maxApv, maxPoints, grouped=False):
+	"""
+	The volcano and MA plots of a diff table. Both are built from one query
+	for the significant rows and one sampled query for the background, so
+	the table is scanned once for the pair.
+
+	@parameter grouped - split significant points into one series per
+							(group1, group2) contrast of the table
+	"""
+	cols = [idcol, 'logFC', 'adj_P_Val', 'AveExpr']
+	if grouped:
+		cols += ['group1', 'group2']
+
+	vSignificant = []
+	mSignificant = []
+	for row in significantRows(table, cols, minLfc, maxApv):
+		gene, lfc, apv, aE = row[:4]
+		vPoint = {'name':gene, 'x':lfc, 'y':-math.log(apv,2)}
+		mPoint = {'name':gene, 'y':lfc, 'x':aE}
+		if grouped:
+			group = "{} {}".format(*row[4:])
+			vPoint = (group, vPoint)
+			mPoint = (group, mPoint)
+		vSignificant.append(vPoint)
+		mSignificant.append(mPoint)
+
+	vBackground = []
+	mBackground = []
+	for lfc, apv, aE in backgroundRows(table, ['logFC', 'adj_P_Val', 'AveExpr'], len(vSignificant), minLfc, maxApv, maxPoints):
+		vBackground.append([lfc,-math.log(apv,2)])
+		mBackground.append([aE,lfc])
+
+	lfcRange = table.columnRange('logFC')
+	thin = thinGroupedSeries if grouped else thinSeries
+	volcano = scatter.plot(thin(vSignificant, vBackground, maxPoints),
+							pconfig=chartConfig(volcanoTitle,
+												'average log fold change',
+												'Negative log of adjusted p value',
+												lfcRange,
+												volcanoYRange(table)))
+	ma = scatter.plot(thin(mSignificant, mBackground, maxPoints),
+							pconfig=chartConfig(maTitle,
+												'Ave. Expression',
+												'Ave. Log Fold Change',
+												table.columnRange('AveExpr'),
+												lfcRange))
+	return volcano, ma
+
+def chartConfig(title, xlab, ylab, xRange, yRange):
+	return {
+			'ylab':ylab, 
+			'xlab':xlab, 
+			'id':plotId(title),
+			'title':title,
+			'legend':True,
+			'xmin':xRange[0],
+			'xmax':xRange[1],
+			'ymin':yRange[0],
+			'ymax':yRange[1],
+			}
+
+
+def indexDiffTable(table):
+	"""
+	Index the columns the charts filter on and take extents of
+	"""
+	for col in ('logFC', 'adj_P_Val', 'AveExpr'):
+		table.createIndex(col)
+
+def significantRows(table, cols, minLfc, maxApv):
+	"""
+	Rows passing the significance thresholds, found through the adj_P_Val
+	index, in table order
+	"""
+	cmd = "SELECT rowid, {} FROM {{table_name}} WHERE {}".format(', '.join(cols), significantWhere)
+	return [row[1:] for row in sorted(table.query(cmd, (minLfc, maxApv)))]
+
+def backgroundRows(table, cols, nSignificant, minLfc, maxApv, maxPoints):
+	"""
+	Rows failing the significance thresholds. Large backgrounds are
+	sampled every n-th row in SQL down to about backgroundOversample
+	times maxPoints, so only those rows reach Python and the downsampler.
+	"""
+	nBackground = table.query("SELECT COUNT(*) FROM {table_name}").fetchone()[0] - nSignificant
+	stride = max(1, int(math.ceil(nBackground / float(backgroundOversample * maxPoints))))
+	cmd = "SELECT {} FROM {{table_name}} WHERE NOT ({}) AND rowid % ? = 0".format(', '.join(cols), significantWhere)
+	return table.query(cmd, (minLfc, maxApv, stride)).fetchall()
+
+def volcanoYRange(table):
+	"""
+	The volcano y axis is -log2(adj_P_Val), so its extents come from the
+	p value extents the other way round
+	"""
+	pmin, pmax = table.columnRange('adj_P_Val')
+	return -math.log(pmax,2), -math.log(pmin,2)
+
+def plotId(title):
+	"""
+	Plot ids made from the title, so a report is the same from run to run
+	"""
+	return 'sig_' + re.sub('[^A-Za-z0-9_-]', '_', title)
+
+def thinSeries(significant, background, maxPoints):
+	"""
+	Downsample significant and background points to at most maxPoints together
+	"""
+	nSig, nBackground = splitBudget(len(significant), len(background), maxPoints)
+	return {
+		'significant' : thinPoints(significant, lambda p: (p['x'], p['y']), nSig, config.significance_seed),
+		'not significant (rarefied)' : thinPoints(background, lambda p: p, nBackground, config.significance_seed),
+		}
+
+def thinGroupedSeries(significant, background, maxPoints):
+	"""
+	thinSeries where significant is a list of (group, point), giving one series per group
+	"""
+	nSig, nBackground = splitBudget(len(significant), len(background), maxPoints)
+	significant = thinPoints(significant, lambda gp: (gp[1]['x'], gp[1]['y']), nSig, config.significance_seed)
+	lava = {'not significant (rarefied)': thinPoints(background, lambda p: p, nBackground, config.significance_seed)}
+	for group, point in significant:
+		if group not in lava:
+			lava[group] = []
+		lava[group].append(point)
+	return lava
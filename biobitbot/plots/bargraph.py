@@ -17,6 +17,7 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 from biobitbot.utils import report, config
+from biobitbot.plots import packed
 logger = logging.getLogger(__name__)
 
 letters = 'abcdefghijklmnopqrstuvwxyz'
@@ -157,7 +158,7 @@ def highcharts_bargraph (plotdata, plotsamples=None, pconfig={}):
             "datasets": {d}, \n\
             "config": {c} \n\
         }} \n\
-    </script>'.format(id=pconfig['id'], s=json.dumps(plotsamples), d=json.dumps(plotdata), c=json.dumps(pconfig));
+    </script>'.format(id=pconfig['id'], s=json.dumps([report.dataset_ref(samples) for samples in plotsamples]), d=json.dumps(report.share_plot_data(packed.packPlotData(plotdata))), c=json.dumps(pconfig));
     
     report.num_hc_plots += 1
     return html
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Compact encoding of the numeric data of large plots.
+
+A packed series carries its values as base64 strings of little endian
+float32 arrays, one per column, in place of a JSON list of numbers,
+[x, y] lists or {'x':.., 'y':..} objects. Point names are kept in a
+separate list. The plotting JavaScript decodes each column straight into
+a Float32Array and rebuilds plain arrays for Highcharts, so a point costs
+a few characters of base64 instead of 30-60 of JSON. Columns of integers
+too big for float32 to hold exactly (eg. read counts) are packed as
+float64 instead.
+
+Series that don't fit one of the shapes below are left as they are:
+
+values  - a list of numbers (bar graphs)
+arrays  - a list of equal length lists of numbers ([x, y], box plot rows)
+points  - a list of dicts with the same numeric keys and an optional 'name'
+"""
+
+import base64
+import numbers
+
+import numpy as np
+
+from biobitbot.utils import config
+
+# float32 holds every integer up to this exactly
+float32MaxExactInt = 2**24
+
+
+def packColumn(values):
+	"""
+	@return - (dtype, base64 string) for a list of numbers
+	"""
+	values = np.asarray(values, dtype=np.float64)
+	dtype = '<f4'
+	if values.size > 0 and np.all(values == np.round(values)) and np.abs(values).max() > float32MaxExactInt:
+		dtype = '<f8'
+	return dtype[1:], base64.b64encode(values.astype(dtype).tobytes()).decode('ascii')
+
+
+def isNumber(val):
+	return isinstance(val, numbers.Real) and not isinstance(val, bool)
+
+
+def seriesColumns(data):
+	"""
+	Split a series' points into columns
+
+	@return - (shape, keys, columns, names) or None if the points can't be packed
+	"""
+	first = data[0]
+	if isNumber(first):
+		if all(isNumber(val) for val in data):
+			return 'values', None, [data], None
+	elif isinstance(first, (list, tuple)):
+		width = len(first)
+		if all(isinstance(point, (list, tuple)) and len(point) == width and all(isNumber(val) for val in point)
+				for point in data):
+			return 'arrays', None, [list(col) for col in zip(*data)], None
+	elif isinstance(first, dict):
+		keys = sorted(key for key in first if key != 'name')
+		hasNames = 'name' in first
+		for point in data:
+			if not isinstance(point, dict) or len(point) != len(keys) + hasNames or ('name' in point) != hasNames:
+				return None
+			if not all(isNumber(point.get(key)) for key in keys):
+				return None
+		columns = [[point[key] for key in keys] for point in data]
+		columns = [list(col) for col in zip(*columns)]
+		names = [point['name'] for point in data] if hasNames else None
+		return 'points', keys, columns, names
+	return None
+
+
+def packSeries(series):
+	"""
+	A copy of a {'name':.., 'data':[..]} series with its data packed, or
+	the series itself if it can't be packed
+	"""
+	data = series.get('data')
+	if not data:
+		return series
+	split = seriesColumns(data)
+	if split is None:
+		return series
+	shape, keys, columns, names = split
+	packed = {'shape': shape, 'length': len(data), 'dtypes': [], 'columns': []}
+	for col in columns:
+		dtype, encoded = packColumn(col)
+		packed['dtypes'].append(dtype)
+		packed['columns'].append(encoded)
+	if keys is not None:
+		packed['keys'] = keys
+	if names is not None:
+		packed['names'] = names
+	newSeries = {k: v for k, v in series.items() if k != 'data'}
+	newSeries['packed'] = packed
+	return newSeries
+
+
+def countPoints(plotdata):
+	if isinstance(plotdata, dict):
+		return len(plotdata.get('data') or [])
+	return sum(countPoints(item) for item in plotdata)
+
+
+def packPlotData(plotdata, force=False):
+	"""
+	Pack every series of a plot's datasets, a list of series or a list of
+	lists of series, if the plot has at least config.plots_packed_min_points
+	points. Smaller plots, or all plots if the setting is None, are returned
+	unchanged.
+
+	@parameter force - pack whatever the size of the plot, eg. so plots
+						sharing an axis can share its column
+	"""
+	minPoints = config.plots_packed_min_points
+	if not force and (minPoints is None or countPoints(plotdata) < minPoints):
+		return plotdata
+	return packNested(plotdata)
+
+
+def packNested(plotdata):
+	if isinstance(plotdata, dict):
+		return packSeries(plotdata)
+	return [packNested(item) for item in plotdata]
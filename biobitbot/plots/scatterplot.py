@@ -15,6 +15,7 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 from biobitbot.utils import report, config
+from biobitbot.plots import packed
 logger = logging.getLogger(__name__)
 
 letters = 'abcdefghijklmnopqrstuvwxyz'
@@ -59,7 +60,7 @@ def highcharts_scatterplot(plotdata, pconfig={}):
 			"config": {c}
 		}}
 		</script>
-		""".format(id=pconfig['id'], d=json.dumps(plotdata), c=json.dumps(pconfig))
+		""".format(id=pconfig['id'], d=json.dumps(report.share_plot_data(packed.packPlotData(plotdata, force=pconfig.get('pack_data', False)))), c=json.dumps(pconfig))
 
 	report.num_hc_plots += 1
 	html += js
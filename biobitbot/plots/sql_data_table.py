@@ -132,6 +132,41 @@ class SqlDataTable(object):
 
 		return cols, rows
 
+	def query(self, sqlCmd, params=()):
+		"""
+		Run a query with '?' placeholders bound to params and return the
+		cursor over its rows. Unlike getTable the selected columns may be
+		expressions or aggregates.
+		"""
+		sqlCmd = sqlCmd.format(table_name=self.name)
+		cur = self.db.cursor()
+		return cur.execute(sqlCmd, params)
+
+	def createIndex(self, columns):
+		"""
+		Index the table on one column or a list of columns. Does nothing
+		if the index already exists, so modules sharing a table can each
+		ask for the indexes they use.
+		"""
+		if isinstance(columns, basestring):
+			columns = [columns]
+		indexName = '{}_{}_idx'.format(self.name, '_'.join(columns))
+		cur = self.db.cursor()
+		cmd = "CREATE INDEX IF NOT EXISTS {} ON {} ({});".format(indexName, self.name, ', '.join(columns))
+		cur.execute(cmd)
+		self.db.commit()
+
+	def columnRange(self, column):
+		"""
+		(min, max) of the numeric values of a column, (None, None) if it has
+		none. SQLite sorts text after every number, so the "< ''" bound skips
+		values like 'NA' and lets both aggregates be read off an index on the
+		column instead of scanning the table.
+		"""
+		cmd = ("SELECT (SELECT MIN({col}) FROM {{table_name}} WHERE {col} < ''), "
+				"(SELECT MAX({col}) FROM {{table_name}} WHERE {col} < '')").format(col=column)
+		return self.query(cmd).fetchone()
+
 
 	def as_html(self, sqlCmd="SELECT * FROM {table_name}"):
 		table_html = {
@@ -54,9 +54,62 @@ def highcharts_treemap(plotdata, pconfig={}):
 			"config": {c}
 		}}
 		</script>
-		""".format(id=pconfig['id'], d=json.dumps(plotdata), c=json.dumps(pconfig));
+		""".format(id=pconfig['id'], d=json.dumps([report.dataset_ref(tree) for tree in plotdata]), c=json.dumps(pconfig));
 	
 
 	report.num_hc_plots += 1
 	html += js
-	return html
\ No newline at end of file
+	return html
+
+
+def plot_skeleton(skeletonId, parents, names, comparator):
+	"""
+	Emit the structure of a treemap once so that several treemaps (eg. one
+	per condition) can share it, each only carrying its own values. See
+	plot_values.
+
+	@parameter skeletonId - id the treemaps refer to the skeleton by
+	@parameter parents - index of each node's parent, -1 for top level nodes.
+						Parents must come before their children.
+	@parameter names - name of each node
+	@parameter comparator - value of each node to compare against, sets the colour
+	"""
+	assert len(parents) == len(names) == len(comparator)
+	return """
+		<script type="text/javascript">
+		mqc_plots["{id}"] = {{
+			"plot_type": "treemap_skeleton",
+			"parents": {p},
+			"names": {n},
+			"comparator": {c}
+		}}
+		</script>
+		""".format(id=skeletonId,
+					p=json.dumps(report.dataset_ref(parents)),
+					n=json.dumps(report.dataset_ref(names)),
+					c=json.dumps(report.dataset_ref(comparator)))
+
+
+def plot_values(skeletonId, values, pconfig={}):
+	"""
+	Plot a treemap over a skeleton emitted with plot_skeleton
+
+	@parameter skeletonId - id given to plot_skeleton
+	@parameter values - value of each node of the skeleton
+	"""
+	if pconfig.get('id') is None:
+		pconfig['id'] = 'mqc_hcplot_'+''.join(random.sample(letters, 10))
+	html = '<div class="mqc_hcplot_plotgroup">'
+	html += '<div class="hc-plot-wrapper"><div id="{id}" class="hc-plot not_rendered"><small>loading..</small></div></div></div> \n'.format(id=pconfig['id'])
+	html += """
+		<script type="text/javascript">
+		mqc_plots["{id}"] = {{
+			"plot_type": "treemap",
+			"skeleton": "{s}",
+			"datasets": {d},
+			"config": {c}
+		}}
+		</script>
+		""".format(id=pconfig['id'], s=skeletonId, d=json.dumps(report.dataset_ref(values)), c=json.dumps(pconfig))
+	report.num_hc_plots += 1
+	return html
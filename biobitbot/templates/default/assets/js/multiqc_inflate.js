@@ -0,0 +1,253 @@
+////////////////////////////////////////////////
+// Gzip decompression of report data blocks
+////////////////////////////////////////////////
+
+// A small synchronous DEFLATE decoder (RFC 1951) for the gzip (RFC 1952)
+// compressed plot data written by report.datasets_js. Blocks are only
+// inflated when the plot using them is first drawn.
+
+/*
+ * Ported from tiny-inflate (https://github.com/foliojs/tiny-inflate), which
+ * is in turn a port of tinf (https://github.com/jibsen/tinf). Altered from
+ * the originals: the decoder is wrapped in the mqc_inflate module, and gzip
+ * header parsing and output buffer sizing from the gzip trailer were added.
+ *
+ * tiny-inflate - Copyright (c) 2015 Devon Govett
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a
+ * copy of this software and associated documentation files (the "Software"),
+ * to deal in the Software without restriction, including without limitation
+ * the rights to use, copy, modify, merge, publish, distribute, sublicense,
+ * and/or sell copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be included in
+ * all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ * AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ * DEALINGS IN THE SOFTWARE.
+ *
+ * tinf - tiny inflate library - Copyright (c) 2003 Joergen Ibsen
+ *
+ * This software is provided 'as-is', without any express or implied
+ * warranty. In no event will the authors be held liable for any damages
+ * arising from the use of this software.
+ *
+ * Permission is granted to anyone to use this software for any purpose,
+ * including commercial applications, and to alter it and redistribute it
+ * freely, subject to the following restrictions:
+ *
+ * 1. The origin of this software must not be misrepresented; you must not
+ *    claim that you wrote the original software. If you use this software
+ *    in a product, an acknowledgment in the product documentation would be
+ *    appreciated but is not required.
+ *
+ * 2. Altered source versions must be plainly marked as such, and must not be
+ *    misrepresented as being the original software.
+ *
+ * 3. This notice may not be removed or altered from any source distribution.
+ */
+
+var mqc_inflate = (function(){
+
+  function Tree(){
+    this.table = new Uint16Array(16);  // number of codes of each length
+    this.trans = new Uint16Array(288); // code to symbol
+  }
+
+  var length_bits = new Uint8Array(30);
+  var length_base = new Uint16Array(30);
+  var dist_bits = new Uint8Array(30);
+  var dist_base = new Uint16Array(30);
+  var clcidx = new Uint8Array([16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15]);
+  var fixed_lt = new Tree();
+  var fixed_dt = new Tree();
+  var code_tree = new Tree();
+  var lengths = new Uint8Array(288 + 32);
+  var offs = new Uint16Array(16);
+
+  function build_bits_base(bits, base, delta, first){
+    var i, sum;
+    for (i = 0; i < delta; ++i){ bits[i] = 0; }
+    for (i = 0; i < 30 - delta; ++i){ bits[i + delta] = i / delta | 0; }
+    for (sum = first, i = 0; i < 30; ++i){
+      base[i] = sum;
+      sum += 1 << bits[i];
+    }
+  }
+
+  function build_fixed_trees(lt, dt){
+    var i;
+    for (i = 0; i < 7; ++i){ lt.table[i] = 0; }
+    lt.table[7] = 24;
+    lt.table[8] = 152;
+    lt.table[9] = 112;
+    for (i = 0; i < 24; ++i){ lt.trans[i] = 256 + i; }
+    for (i = 0; i < 144; ++i){ lt.trans[24 + i] = i; }
+    for (i = 0; i < 8; ++i){ lt.trans[24 + 144 + i] = 280 + i; }
+    for (i = 0; i < 112; ++i){ lt.trans[24 + 144 + 8 + i] = 144 + i; }
+    for (i = 0; i < 5; ++i){ dt.table[i] = 0; }
+    dt.table[5] = 32;
+    for (i = 0; i < 32; ++i){ dt.trans[i] = i; }
+  }
+
+  function build_tree(t, lens, off, num){
+    var i, sum;
+    for (i = 0; i < 16; ++i){ t.table[i] = 0; }
+    for (i = 0; i < num; ++i){ t.table[lens[off + i]]++; }
+    t.table[0] = 0;
+    for (sum = 0, i = 0; i < 16; ++i){
+      offs[i] = sum;
+      sum += t.table[i];
+    }
+    for (i = 0; i < num; ++i){
+      if (lens[off + i]){ t.trans[offs[lens[off + i]]++] = i; }
+    }
+  }
+
+  function getbit(d){
+    if (!d.bitcount--){
+      d.tag = d.source[d.index++];
+      d.bitcount = 7;
+    }
+    var bit = d.tag & 1;
+    d.tag >>>= 1;
+    return bit;
+  }
+
+  function read_bits(d, num, base){
+    if (!num){ return base; }
+    while (d.bitcount < 24){
+      d.tag |= d.source[d.index++] << d.bitcount;
+      d.bitcount += 8;
+    }
+    var val = d.tag & (0xffff >>> (16 - num));
+    d.tag >>>= num;
+    d.bitcount -= num;
+    return val + base;
+  }
+
+  function decode_symbol(d, t){
+    while (d.bitcount < 24){
+      d.tag |= d.source[d.index++] << d.bitcount;
+      d.bitcount += 8;
+    }
+    var sum = 0, cur = 0, len = 0, tag = d.tag;
+    do {
+      cur = 2 * cur + (tag & 1);
+      tag >>>= 1;
+      ++len;
+      sum += t.table[len];
+      cur -= t.table[len];
+    } while (cur >= 0);
+    d.tag = tag;
+    d.bitcount -= len;
+    return t.trans[sum + cur];
+  }
+
+  function decode_trees(d, lt, dt){
+    var hlit = read_bits(d, 5, 257);
+    var hdist = read_bits(d, 5, 1);
+    var hclen = read_bits(d, 4, 4);
+    var i, num, length, prev, sym;
+    for (i = 0; i < 19; ++i){ lengths[i] = 0; }
+    for (i = 0; i < hclen; ++i){ lengths[clcidx[i]] = read_bits(d, 3, 0); }
+    build_tree(code_tree, lengths, 0, 19);
+    for (num = 0; num < hlit + hdist;){
+      sym = decode_symbol(d, code_tree);
+      if (sym == 16){
+        prev = lengths[num - 1];
+        for (length = read_bits(d, 2, 3); length; --length){ lengths[num++] = prev; }
+      } else if (sym == 17){
+        for (length = read_bits(d, 3, 3); length; --length){ lengths[num++] = 0; }
+      } else if (sym == 18){
+        for (length = read_bits(d, 7, 11); length; --length){ lengths[num++] = 0; }
+      } else {
+        lengths[num++] = sym;
+      }
+    }
+    build_tree(lt, lengths, 0, hlit);
+    build_tree(dt, lengths, hlit, hdist);
+  }
+
+  function inflate_block_data(d, lt, dt){
+    var dest = d.dest;
+    var sym, length, dist, start, end, i;
+    while (true){
+      sym = decode_symbol(d, lt);
+      if (sym === 256){ return; }
+      if (sym < 256){
+        dest[d.length++] = sym;
+      } else {
+        sym -= 257;
+        length = read_bits(d, length_bits[sym], length_base[sym]);
+        dist = decode_symbol(d, dt);
+        start = d.length - read_bits(d, dist_bits[dist], dist_base[dist]);
+        end = d.length;
+        // Byte by byte, as a match may overlap the bytes it writes
+        for (i = 0; i < length; ++i){ dest[end + i] = dest[start + i]; }
+        d.length = end + length;
+      }
+    }
+  }
+
+  function inflate_stored_block(d){
+    // Give back whole bytes read ahead into the bit buffer
+    while (d.bitcount >= 8){
+      d.index--;
+      d.bitcount -= 8;
+    }
+    var length = d.source[d.index] | (d.source[d.index + 1] << 8);
+    d.index += 4;
+    for (var i = 0; i < length; ++i){ d.dest[d.length++] = d.source[d.index++]; }
+    d.tag = 0;
+    d.bitcount = 0;
+  }
+
+  build_bits_base(length_bits, length_base, 4, 3);
+  build_bits_base(dist_bits, dist_base, 2, 1);
+  length_bits[28] = 0;
+  length_base[28] = 258;
+  build_fixed_trees(fixed_lt, fixed_dt);
+
+  // Decompress a gzip member, given and returned as Uint8Arrays
+  return function(source){
+    if (source[0] != 0x1f || source[1] != 0x8b || source[2] != 8){
+      throw new Error('Not gzip data');
+    }
+    var flags = source[3];
+    var index = 10;
+    if (flags & 4){ index += 2 + (source[index] | (source[index + 1] << 8)); }
+    if (flags & 8){ while (source[index++]){} }
+    if (flags & 16){ while (source[index++]){} }
+    if (flags & 2){ index += 2; }
+    var n = source.length;
+    var size = (source[n - 4] | (source[n - 3] << 8) | (source[n - 2] << 16) | (source[n - 1] << 24)) >>> 0;
+    var d = {
+      source: source, index: index, tag: 0, bitcount: 0,
+      dest: new Uint8Array(size), length: 0,
+      lt: new Tree(), dt: new Tree()
+    };
+    var bfinal, btype;
+    do {
+      bfinal = getbit(d);
+      btype = read_bits(d, 2, 0);
+      if (btype == 0){
+        inflate_stored_block(d);
+      } else if (btype == 1){
+        inflate_block_data(d, fixed_lt, fixed_dt);
+      } else if (btype == 2){
+        decode_trees(d, d.lt, d.dt);
+        inflate_block_data(d, d.lt, d.dt);
+      } else {
+        throw new Error('Bad deflate block type');
+      }
+    } while (!bfinal);
+    return d.dest;
+  };
+})();
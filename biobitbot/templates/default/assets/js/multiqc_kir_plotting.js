@@ -7,6 +7,8 @@ function plot_xy_scatter_plot(target, ds) {
   var data = mqc_plots[target]['datasets'];
   if(ds === undefined){ ds = 0; }
   
+  // Packed values are float32, so don't show all their digits
+  if(config['tt_label'] === undefined && mqc_plots[target]['packed']){ config['tt_label'] = '{point.x:.2f}: {point.y:.2f}'; }
   if(config['tt_label'] === undefined){ config['tt_label'] = '{point.x}: {point.y:.2f}'; }
   if(config['click_func'] === undefined){ config['click_func'] = function(){}; }
   else {
@@ -298,7 +300,6 @@ function plot_treemap(target, ds) {
     return false;
   }
   var config = mqc_plots[target]['config'];
-  var data = mqc_plots[target]['datasets'];
   if(ds === undefined){ ds = 0; }
   
   if(config['tt_label'] === undefined){ config['tt_label'] = '{point.x}: {point.y:.2f}'; }
@@ -312,72 +313,257 @@ function plot_treemap(target, ds) {
   if (config['pointFormat'] === undefined){
     config['pointFormat'] = '<div style="background-color:{series.color}; display:inline-block; height: 10px; width: 10px; border:1px solid #333;"></div> <span style="text-decoration:underline; font-weight:bold;">{series.name}</span><br>'+config['tt_label'];
   }
-  
-  // Make a clone of the data, so that we can mess with it,
-  // while keeping the original data in tact
-  var data = JSON.parse(JSON.stringify(mqc_plots[target]['datasets'][0]));
+  // Number of levels shown before the user drills into a node
+  if (config['initial_depth'] === undefined){ config['initial_depth'] = 3; }
+
+  var points;
+  var skeleton;
+  var values = mqc_plots[target]['datasets'];
+  if(mqc_plots[target]['skeleton'] !== undefined){
+    // Structure and comparator shared by several treemaps, values for this one.
+    // Only the top levels, and any nodes drilled into before, are turned into points.
+    skeleton = treemap_skeleton_index(mqc_plots[mqc_plots[target]['skeleton']]);
+    if(mqc_plots[target]['expanded'] === undefined){
+      mqc_plots[target]['expanded'] = {};
+      treemap_expand(skeleton, mqc_plots[target]['expanded'], skeleton['roots'], config['initial_depth'] - 1);
+    }
+    var nodes = treemap_visible_nodes(skeleton, mqc_plots[target]['expanded'], skeleton['roots']);
+    points = treemap_skeleton_points(skeleton, values, nodes);
+  } else {
+    // The recursion only reads the data, so it doesn't need cloning
+    points = treemap_nested_points(values[0], values[1]);
+  }
+
+  // Hide samples
+  $('#'+target).closest('.mqc_hcplot_plotgroup').parent().find('.samples-hidden-warning').remove();
+  $('#'+target).closest('.mqc_hcplot_plotgroup').show();
+  var shown = treemap_toolbox(points);
+  points = shown['points'];
+  // Some series hidden. Show a warning text string.
+  if(shown['num_hidden'] > 0) {
+    var alert = '<div class="samples-hidden-warning alert alert-warning"><span class="glyphicon glyphicon-info-sign"></span> <strong>Warning:</strong> '+shown['num_hidden']+' samples hidden in toolbox. <a href="#mqc_hidesamples" class="alert-link" onclick="mqc_toolbox_openclose(\'#mqc_hidesamples\', true); return false;">See toolbox.</a></div>';
+    $('#'+target).closest('.mqc_hcplot_plotgroup').before(alert);
+  }
+  // Everything hidden. Hide the graph.
+  if(points.length == 0){
+    $('#'+target).closest('.mqc_hcplot_plotgroup').hide();
+    return false;
+  }
+
+  // Drilling into a node whose children aren't points yet adds the
+  // levels below it, then drills in
+  var drill_lazily = function(){
+    var i = parseInt(this.id.substr(1));
+    if(skeleton === undefined || mqc_plots[target]['expanded'][i] || skeleton['children'][i].length == 0){
+      return true;
+    }
+    var series = this.series;
+    treemap_expand(skeleton, mqc_plots[target]['expanded'], [i], config['initial_depth']);
+    var below = treemap_visible_nodes(skeleton, mqc_plots[target]['expanded'], skeleton['children'][i]);
+    var added = treemap_toolbox(treemap_skeleton_points(skeleton, values, below))['points'];
+    series.setData(series.options.data.concat(added), false);
+    if(series.setRootNode !== undefined){
+      series.setRootNode(this.id, true);
+    } else {
+      series.drillToNode(this.id);
+    }
+    return false;
+  };
+
+  $(function () {
+    $('#'+target).highcharts({
+        series: [{
+            turboThreshold : 0,
+            type: 'treemap',
+            layoutAlgorithm: 'squarified',
+            allowDrillToNode: true,
+            animationLimit: 1000,
+            dataLabels: {
+                enabled: false
+            },
+            levelIsConstant: false,
+            levels: [{
+                level: 1,
+                dataLabels: {
+                    enabled: true
+                },
+                borderWidth: 3
+            }],
+            point: {
+                events: {
+                    click: drill_lazily
+                }
+            },
+            data: points
+        }],
+        subtitle: {
+            text: config['subtitle']
+        },
+        title: {
+            text: config['title']
+        },
+        colorAxis: {
+          stops : [
+            [0, Highcharts.getOptions().colors[0]],
+            [0.57, '#F5F5F5'],
+            [1, Highcharts.getOptions().colors[8]]
+          ],
+            type:'logarithmic',
+            min: 0.5,
+            max: 2,
+
+        },
+    });
+  });
+}
+
+// Add child lists, top level nodes and depths to a treemap skeleton
+// (parent index and name of every node, in pre-order, plus a comparator
+// value for the colour). Done once and shared by all of its treemaps.
+function treemap_skeleton_index(skeleton){
+  if(skeleton['children'] !== undefined){
+    return skeleton;
+  }
+  resolve_dataset_refs(skeleton);
+  var parents = skeleton['parents'];
+  var children = new Array(parents.length);
+  var depths = new Array(parents.length);
+  var roots = [];
+  for (var i = 0; i < parents.length; i++) {
+    children[i] = [];
+    if(parents[i] >= 0){
+      children[parents[i]].push(i);
+      depths[i] = depths[parents[i]] + 1;
+    } else {
+      roots.push(i);
+      depths[i] = 0;
+    }
+  }
+  skeleton['children'] = children;
+  skeleton['depths'] = depths;
+  skeleton['roots'] = roots;
+  return skeleton;
+}
+
+// Mark the nodes from which to show children: the given nodes and their
+// descendants, down to levels below them
+function treemap_expand(skeleton, expanded, nodes, levels){
+  var stack = nodes.slice();
+  var maxDepth = {};
+  $.each(nodes, function(j, i){ maxDepth[i] = skeleton['depths'][i] + levels; });
+  while(stack.length > 0){
+    var i = stack.pop();
+    var limit = maxDepth[i];
+    if(skeleton['depths'][i] >= limit){ continue; }
+    expanded[i] = true;
+    $.each(skeleton['children'][i], function(j, c){
+      maxDepth[c] = limit;
+      stack.push(c);
+    });
+  }
+}
+
+// The given nodes and everything below them that is shown, in pre-order
+function treemap_visible_nodes(skeleton, expanded, nodes){
+  var visible = [];
+  var stack = nodes.slice().reverse();
+  while(stack.length > 0){
+    var i = stack.pop();
+    visible.push(i);
+    if(expanded[i]){
+      var children = skeleton['children'][i];
+      for (var j = children.length - 1; j >= 0; j--) {
+        stack.push(children[j]);
+      }
+    }
+  }
+  return visible;
+}
+
+// Treemap points for some nodes of a skeleton, with the values of one treemap
+function treemap_skeleton_points(skeleton, values, nodes){
+  var parents = skeleton['parents'];
+  var names = skeleton['names'];
+  var comparator = skeleton['comparator'];
+  var points = new Array(nodes.length);
+  for (var j = 0; j < nodes.length; j++) {
+    var i = nodes[j];
+    var P = {
+      id: 'n' + i,
+      name: names[i],
+      value: skeleton['children'][i].length > 0 ? (values[i] || 1) : values[i],
+      colorValue: 0.000001 + values[i] / comparator[i]
+    };
+    if(parents[i] >= 0){ P.parent = 'n' + parents[i]; }
+    points[j] = P;
+  }
+  return points;
+}
 
-  var comparator = JSON.parse(JSON.stringify(mqc_plots[target]['datasets'][1]));
+// Rename, highlight and hide treemap points with the toolbox. Hiding a
+// point hides everything below it. Points must be in pre-order.
+function treemap_toolbox(points){
 
   // Rename samples
   if(window.mqc_rename_f_texts.length > 0){
-    $.each(data, function(j, s){
+    $.each(points, function(j, P){
       $.each(window.mqc_rename_f_texts, function(idx, f_text){
         if(window.mqc_rename_regex_mode){
           var re = new RegExp(f_text,"g");
-          data[j]['name'] = data[j]['name'].replace(re, window.mqc_rename_t_texts[idx]);
+          P.name = P.name.replace(re, window.mqc_rename_t_texts[idx]);
         } else {
-          data[j]['name'] = data[j]['name'].replace(f_text, window.mqc_rename_t_texts[idx]);
+          P.name = P.name.replace(f_text, window.mqc_rename_t_texts[idx]);
         }
       });
     });
   }
 
-
   // Highlight samples
   if(window.mqc_highlight_f_texts.length > 0){
-    $.each(data, function(j, s){
+    $.each(points, function(j, P){
       $.each(window.mqc_highlight_f_texts, function(idx, f_text){
-        if((window.mqc_highlight_regex_mode && data[j]['name'].match(f_text)) || (!window.mqc_highlight_regex_mode && data[j]['name'].indexOf(f_text) > -1)){
-          data[j]['color'] = window.mqc_highlight_f_cols[idx];
+        if((window.mqc_highlight_regex_mode && P.name.match(f_text)) || (!window.mqc_highlight_regex_mode && P.name.indexOf(f_text) > -1)){
+          P.color = window.mqc_highlight_f_cols[idx];
         }
       });
     });
   }
-  
+
   // Hide samples
-  $('#'+target).closest('.mqc_hcplot_plotgroup').parent().find('.samples-hidden-warning').remove();
-  $('#'+target).closest('.mqc_hcplot_plotgroup').show();
+  var num_hidden = 0;
   if(window.mqc_hide_f_texts.length > 0){
-    var num_hidden = 0;
-    var num_total = data.length;
-    var j = data.length;
-    while (j--) {
+    var hidden = {};
+    var shown = [];
+    $.each(points, function(j, P){
+      if(P.parent !== undefined && hidden[P.parent]){
+        hidden[P.id] = true;
+        return true;
+      }
+      var match = false;
       $.each(window.mqc_hide_f_texts, function(idx, f_text){
-        var match = (window.mqc_hide_regex_mode && data[j]['name'].match(f_text)) || (!window.mqc_hide_regex_mode && data[j]['name'].indexOf(f_text) > -1);
-        if(window.mqc_hide_mode == 'show'){
-          match = !match;
-        }
-        if(match){
-          data.splice(j,1);
-          num_hidden += 1;
-          console.log('hiding')
+        if((window.mqc_hide_regex_mode && P.name.match(f_text)) || (!window.mqc_hide_regex_mode && P.name.indexOf(f_text) > -1)){
+          match = true;
           return false;
         }
       });
-    };
-    // Some series hidden. Show a warning text string.
-    if(num_hidden > 0) {
-      var alert = '<div class="samples-hidden-warning alert alert-warning"><span class="glyphicon glyphicon-info-sign"></span> <strong>Warning:</strong> '+num_hidden+' samples hidden in toolbox. <a href="#mqc_hidesamples" class="alert-link" onclick="mqc_toolbox_openclose(\'#mqc_hidesamples\', true); return false;">See toolbox.</a></div>';
-      $('#'+target).closest('.mqc_hcplot_plotgroup').before(alert);
-    }
-    // All series hidden. Hide the graph.
-    if(num_hidden == num_total){
-      $('#'+target).closest('.mqc_hcplot_plotgroup').hide();
-      return false;
-    }
+      if(window.mqc_hide_mode == 'show'){
+        match = !match;
+      }
+      if(match){
+        hidden[P.id] = true;
+        num_hidden += 1;
+      } else {
+        shown.push(P);
+      }
+    });
+    points = shown;
   }
+  return {'points': points, 'num_hidden': num_hidden};
+}
 
+// Build treemap points from nested objects of {name: child, 'size': value},
+// with numbers for leaves, and a comparator of the same shape for the colour
+function treemap_nested_points(data, comparator){
   // Recursive tree map for objects.
 
 function standardCase(parent,aveparent,idin){
@@ -482,47 +668,7 @@ function rPlot(parent,aveparent,idin){
   }
 };
 
-  $(function () {
-    var points = rPlot(data,comparator,'TOP')['cpoints'];
-    $('#'+target).highcharts({
-        series: [{
-            turboThreshold : 0,
-            type: 'treemap',
-            layoutAlgorithm: 'squarified',
-            allowDrillToNode: true,
-            animationLimit: 1000,
-            dataLabels: {
-                enabled: false
-            },
-            levelIsConstant: false,
-            levels: [{
-                level: 1,
-                dataLabels: {
-                    enabled: true
-                },
-                borderWidth: 3
-            }],
-            data: points
-        }],
-        subtitle: {
-            text: config['subtitle']
-        },
-        title: {
-            text: config['title']
-        },
-        colorAxis: {
-          stops : [
-            [0, Highcharts.getOptions().colors[0]],
-            [0.57, '#F5F5F5'],
-            [1, Highcharts.getOptions().colors[8]]
-          ],
-            type:'logarithmic',
-            min: 0.5,
-            max: 2,
-
-        },
-    });
-  });
+  return rPlot(data,comparator,'TOP')['cpoints'];
 }
 
 // // Recursive tree map for objects.
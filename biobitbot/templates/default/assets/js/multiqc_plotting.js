@@ -152,6 +152,20 @@ $(function () {
 function plot_graph(target, ds, max_num, force=false){
   if(mqc_plots[target] === undefined){ return false; }
   else {
+    // Scatter plots and tree maps wait for a click, their data isn't needed before then
+    var plot_type = mqc_plots[target]['plot_type'];
+    if(force || (plot_type != 'xy_scatter' && plot_type != 'treemap')){
+      var missing = missing_plot_data(target);
+      if(missing.length > 0){
+        when_visible(target, function(){
+          load_datasets(missing, function(){ plot_graph(target, ds, max_num, force); }, function(){
+            $('#'+target).addClass('not_rendered').html('<div class="alert alert-danger">Could not load plot data from <code>'+mqc_datasets_src+'</code>.</div>');
+          });
+        });
+        return true;
+      }
+      prepare_plot_data(target);
+    }
     // XY Line charts
     if(mqc_plots[target]['plot_type'] == 'xy_line'){
       if(max_num === undefined || mqc_plots[target]['datasets'][0].length < max_num){
@@ -211,6 +225,215 @@ function plot_graph(target, ds, max_num, force=false){
   }
 }
 
+// Swap dataset references for the shared data (see report.dataset_ref) and
+// decode series packed as base64 typed array columns (see biobitbot/plots/packed.py)
+// into plain arrays, once, before the plot is first drawn
+function prepare_plot_data(target){
+  if(mqc_plots[target]['prepared']){ return; }
+  mqc_plots[target]['datasets'] = resolve_dataset_refs(mqc_plots[target]['datasets']);
+  if(mqc_plots[target]['samples'] !== undefined){
+    mqc_plots[target]['samples'] = resolve_dataset_refs(mqc_plots[target]['samples']);
+  }
+  mqc_plots[target]['packed'] = unpack_datasets(mqc_plots[target]['datasets']);
+  mqc_plots[target]['prepared'] = true;
+}
+
+// Shared data is the same object in every plot using it, so plotting
+// functions must clone it before changing it
+function resolve_dataset_refs(obj){
+  if($.isArray(obj)){
+    for(var i = 0; i < obj.length; i++){
+      obj[i] = resolve_dataset_refs(obj[i]);
+    }
+  } else if(obj !== null && typeof obj === 'object'){
+    if(obj['dataset_ref'] !== undefined){
+      return get_dataset(obj['dataset_ref']);
+    }
+    for(var key in obj){
+      if(obj.hasOwnProperty(key)){
+        obj[key] = resolve_dataset_refs(obj[key]);
+      }
+    }
+  }
+  return obj;
+}
+
+// A shared dataset, inflated and parsed the first time it's used if it
+// was written compressed (see report.datasets_js)
+function get_dataset(key){
+  if(mqc_datasets[key] === undefined && mqc_datasets_gz[key] !== undefined){
+    var json = bytes_to_string(mqc_inflate(base64_to_bytes(mqc_datasets_gz[key])));
+    mqc_datasets[key] = JSON.parse(json);
+    delete mqc_datasets_gz[key];
+  }
+  return mqc_datasets[key];
+}
+
+// Keys of the datasets a plot refers to that are in files not loaded yet
+// (see report.write_dataset_files), including those of a tree map's skeleton
+function missing_plot_data(target){
+  var missing = [];
+  if(mqc_datasets_src === null || mqc_plots[target]['prepared']){ return missing; }
+  find_missing_datasets(mqc_plots[target], missing);
+  var skeleton = mqc_plots[mqc_plots[target]['skeleton']];
+  if(skeleton !== undefined && skeleton['children'] === undefined){
+    find_missing_datasets(skeleton, missing);
+  }
+  return missing;
+}
+function find_missing_datasets(obj, missing){
+  if($.isArray(obj)){
+    for(var i = 0; i < obj.length; i++){
+      find_missing_datasets(obj[i], missing);
+    }
+  } else if(obj !== null && typeof obj === 'object'){
+    var key = obj['dataset_ref'];
+    if(key !== undefined){
+      if(mqc_datasets[key] === undefined && mqc_datasets_gz[key] === undefined && missing.indexOf(key) == -1){
+        missing.push(key);
+      }
+      return;
+    }
+    for(var k in obj){
+      if(obj.hasOwnProperty(k)){
+        find_missing_datasets(obj[k], missing);
+      }
+    }
+  }
+}
+
+// Load dataset files with script tags, which unlike fetching also works for
+// reports opened from disk. Each file calls mqc_dataset_loaded when run.
+// If any file fails to load, error_callback is called once instead.
+var mqc_datasets_loading = {};
+function load_datasets(keys, callback, error_callback){
+  var waiting = keys.length;
+  var failed = false;
+  $.each(keys, function(i, key){
+    if(mqc_datasets_loading[key] === undefined){
+      mqc_datasets_loading[key] = [];
+      var script = document.createElement('script');
+      script.src = mqc_datasets_src + '/' + key + '.js';
+      script.onerror = function(){ mqc_dataset_failed(key); };
+      document.head.appendChild(script);
+    }
+    mqc_datasets_loading[key].push({
+      loaded: function(){
+        waiting--;
+        if(waiting == 0 && !failed){ callback(); }
+      },
+      failed: function(){
+        if(failed){ return; }
+        failed = true;
+        if(error_callback !== undefined){ error_callback(); }
+      }
+    });
+  });
+}
+function mqc_dataset_loaded(key){
+  var callbacks = mqc_datasets_loading[key] || [];
+  delete mqc_datasets_loading[key];
+  $.each(callbacks, function(i, callback){ callback.loaded(); });
+}
+function mqc_dataset_failed(key){
+  var callbacks = mqc_datasets_loading[key] || [];
+  // Forget the key so that the next attempt to draw the plot tries again
+  delete mqc_datasets_loading[key];
+  $.each(callbacks, function(i, callback){ callback.failed(); });
+}
+
+// Call back once a plot's element is scrolled near the viewport. Only the
+// latest callback for an element is kept, so a plot waiting to be drawn is
+// drawn with the latest settings.
+function when_visible(target, callback){
+  var element = document.getElementById(target);
+  if(element === null || window.IntersectionObserver === undefined){
+    callback();
+    return;
+  }
+  var waiting = element.mqc_when_visible !== undefined;
+  element.mqc_when_visible = callback;
+  if(waiting){ return; }
+  var observer = new IntersectionObserver(function(entries){
+    if(!entries[0].isIntersecting){ return; }
+    observer.disconnect();
+    var visible_callback = element.mqc_when_visible;
+    delete element.mqc_when_visible;
+    visible_callback();
+  }, { rootMargin: '200px' });
+  observer.observe(element);
+}
+
+function base64_to_bytes(encoded){
+  var bytes = atob(encoded);
+  var buffer = new Uint8Array(bytes.length);
+  for(var i = 0; i < bytes.length; i++){
+    buffer[i] = bytes.charCodeAt(i);
+  }
+  return buffer;
+}
+
+// The compressed JSON is ASCII, so without a TextDecoder each byte is a character
+function bytes_to_string(bytes){
+  if(window.TextDecoder !== undefined){
+    return new TextDecoder('utf-8').decode(bytes);
+  }
+  var chunks = [];
+  for(var i = 0; i < bytes.length; i += 8192){
+    chunks.push(String.fromCharCode.apply(null, bytes.subarray(i, i + 8192)));
+  }
+  return chunks.join('');
+}
+
+// Unpack every packed series in place, returns whether there were any
+function unpack_datasets(datasets){
+  var unpacked = false;
+  if($.isArray(datasets)){
+    for(var i = 0; i < datasets.length; i++){
+      unpacked = unpack_datasets(datasets[i]) || unpacked;
+    }
+  } else if(datasets !== null && typeof datasets === 'object' && datasets['packed'] !== undefined){
+    unpack_series(datasets);
+    unpacked = true;
+  }
+  return unpacked;
+}
+
+function unpack_column(encoded, dtype){
+  var buffer = base64_to_bytes(encoded);
+  if(dtype == 'f8'){ return new Float64Array(buffer.buffer); }
+  return new Float32Array(buffer.buffer);
+}
+
+function unpack_series(series){
+  var packed = series['packed'];
+  var columns = [];
+  for(var c = 0; c < packed['columns'].length; c++){
+    columns.push(unpack_column(packed['columns'][c], packed['dtypes'][c]));
+  }
+  var names = packed['names'];
+  var width = names === undefined ? columns.length : columns.length + 1;
+  var data = new Array(packed['length']);
+  for(var i = 0; i < data.length; i++){
+    if(packed['shape'] == 'values'){
+      data[i] = columns[0][i];
+    } else {
+      var point = new Array(width);
+      for(var c = 0; c < columns.length; c++){
+        point[c] = columns[c][i];
+      }
+      if(names !== undefined){ point[columns.length] = names[i]; }
+      data[i] = point;
+    }
+  }
+  // Points were objects, tell Highcharts which array element is which key
+  if(packed['shape'] == 'points'){
+    series['keys'] = names === undefined ? packed['keys'] : packed['keys'].concat(['name']);
+  }
+  delete series['packed'];
+  series['data'] = data;
+}
+
 
 // Basic Line Graph
 function plot_xy_line_graph(target, ds) {
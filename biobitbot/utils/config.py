@@ -30,17 +30,46 @@ analysis_dir = [os.getcwd()]
 output_dir = os.path.realpath(os.getcwd())
 output_fn_name = 'biobitbot_report.html'
 data_dir_name = 'biobitbot_data'
+plot_data_dir_name = 'biobitbot_plot_data'
 make_data_dir = True
 force = False
 zip_data_dir = False
 plots_force_flat = False
 plots_force_interactive = False
 plots_flat_numseries = 100
+# Embed the data of interactive plots with at least this many points as packed
+# binary columns rather than JSON. None to always use JSON.
+plots_packed_min_points = 1000
+# Gzip large plot datasets in the report, they're inflated when first plotted
+report_compress_data = False
+# Write plot datasets to files alongside the report, loaded as plots scroll
+# into view. Only for templates that write a report directory.
+report_lazy_data = False
+# Module HTML and plot data are spooled to a temporary file while the report
+# is built, this much of it is kept in memory before moving to disk
+report_spool_max_memory = 8 * 1024 * 1024
 genstats_beeswarm_numseries = 50
 data_format = 'tsv'
 data_format_extensions = {'tsv': 'txt', 'json': 'json', 'yaml': 'yaml'}
 fn_clean_exts = [ '.gz', '.fastq', '.fq', '.bam', '.sam', '.sra', '_tophat', '_star_aligned', '_fastqc', '.hicup', '.counts', '_counts', '.txt' ]
 fn_ignore_files = ['.DS_Store', '*.bam', '*.sam', '*.fq.gz', '*.fastq.gz', '*.fq', '*.fastq', '*.gtf', '*.bed', '*.vcf', '*.txt.gz']
+fn_ignore_dirs = ['.git', '.svn']
+filelist_threads = 8
+filelist_cache = True
+filelist_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'biobitbot')
+rescan = False
+count_matrix_dtype = 'float64'
+parse_cache = True
+parse_cache_dir = os.path.join(filelist_cache_dir, 'tables')
+distance_tile_bytes = 64*1000*1000
+threads = 1
+# Points per volcano/MA plot for each strictness level, and the seed for choosing them
+significance_max_points = {0: 10000, 1: 5000, 2: 3000, 3: 2000}
+significance_seed = 0
+# Phylogeny treemaps keep at most this many children per node, and only nodes
+# with at least this fraction of their rank's abundance. Either may be a dict by rank.
+treemap_max_children = 25
+treemap_min_relative_abundance = 0.0005
 report_id = 'mqc_report_{}'.format(''.join(random.sample('abcdefghijklmnopqrstuvwxyz0123456789', 20)))
 no_version_check = False
 num_datasets_plot_limit = 50
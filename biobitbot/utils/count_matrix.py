@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Dense numeric matrices with labelled rows (taxa, probes, genes...) and
+one column per sample. Used for normalised count and expression
+matrices, which can run to tens of thousands of rows by hundreds of
+samples. Values are held in a single numpy array so each one costs
+4 or 8 bytes rather than a Python object.
+"""
+
+import numpy as np
+from biobitbot.utils.utils import openMaybeZip
+
+parseCountMatrixVersion = 2
+
+class CountMatrix(object):
+
+	def __init__(self, name, rowNames, colNames, data):
+		"""
+		@parameter name - name of the matrix, used in log messages
+		@parameter rowNames - list of row labels (taxa, probe ids...)
+		@parameter colNames - list of sample names, one per column
+		@parameter data - 2D numpy array of shape (rows, samples)
+		"""
+		self.name = name
+		self.rowNames = list(rowNames)
+		self.colNames = list(colNames)
+		self.data = data
+		assert self.data.shape == (len(self.rowNames), len(self.colNames))
+		self.rowIndex = {rowName:i for i, rowName in enumerate(self.rowNames)}
+		self.colIndex = {colName:j for j, colName in enumerate(self.colNames)}
+
+	def __len__(self):
+		return len(self.rowNames)
+
+	@property
+	def shape(self):
+		return self.data.shape
+
+	def column(self, colName):
+		"""
+		Return the values of one sample as a 1D numpy array (a view, not a copy)
+		"""
+		return self.data[:, self.colIndex[colName]]
+
+	def row(self, rowName):
+		"""
+		Return the values of one row across all samples as a 1D numpy array
+		"""
+		return self.data[self.rowIndex[rowName], :]
+
+	def columns(self):
+		"""
+		Iterate over (sample name, values) pairs
+		"""
+		for j, colName in enumerate(self.colNames):
+			yield colName, self.data[:, j]
+
+	def rows(self):
+		"""
+		Iterate over (row name, values) pairs
+		"""
+		for i, rowName in enumerate(self.rowNames):
+			yield rowName, self.data[i, :]
+
+
+def parseCountMatrix(filename, name, idcol, dtype=np.float64, cleanHeader=None):
+	"""
+	Parse a tab separated matrix with a header line of sample names and
+	one column of row labels into a CountMatrix. The numeric columns are
+	converted by numpy in one go rather than value by value.
+
+	@parameter filename - path to the matrix, may be gzipped
+	@parameter name - name of the matrix
+	@parameter idcol - header of the column holding the row labels. If the
+						header has one fewer field than the rows the
+						labels are taken from the first column.
+	@parameter dtype - numpy dtype for the values (float32 or float64)
+	@parameter cleanHeader - optional function applied to each header field
+
+	@return - a CountMatrix
+	"""
+	with openMaybeZip(filename) as f:
+		header = [head.strip().strip('"') for head in f.readline().split()]
+		if cleanHeader is not None:
+			header = [cleanHeader(head) for head in header]
+		lines = [line for line in f if line.strip()]
+
+	if len(lines) == 0:
+		# Without a row there's no telling if the header names the label
+		# column, every field other than idcol is taken to be a sample
+		colNames = [h for h in header if h != idcol]
+		return CountMatrix(name, [], colNames, np.zeros((0, len(colNames)), dtype=dtype))
+
+	ncols = len(lines[0].split('\t'))
+	if ncols == len(header) + 1:
+		header = [idcol] + header
+	idI = header.index(idcol)
+	valueCols = [i for i in range(ncols) if i != idI]
+
+	if idI == 0:
+		rowNames = [line.split('\t', 1)[0] for line in lines]
+	elif idI == ncols - 1:
+		rowNames = [line.rsplit('\t', 1)[-1] for line in lines]
+	else:
+		rowNames = [line.split('\t')[idI] for line in lines]
+	rowNames = [rowName.strip().strip('"') for rowName in rowNames]
+
+	data = np.loadtxt(lines, delimiter='\t', usecols=valueCols, dtype=dtype, ndmin=2)
+	colNames = [header[i] for i in valueCols]
+	return CountMatrix(name, rowNames, colNames, data)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache of parsed input tables.
+
+Parsing the same count matrices and differential expression tables from
+(often gzipped) text on every run is slow. The first time a table is
+parsed its values are saved as binary numpy arrays, alongside a small
+JSON file holding the row and column labels. Later runs memory map the
+arrays instead of parsing the text again.
+
+Entries are keyed on the real path, size and mtime of the input file,
+the kind of table and the version of the parser, so editing a file or
+changing a parser makes the old entry unreachable. Inputs that are shared
+between many reports (eg. a taxonomy) can be keyed on a hash of their
+contents instead, so every copy of the same file uses one entry.
+
+Each parser has a <parser>Version constant next to it (eg.
+parseCountMatrixVersion), passed to cachedParse as its version. Bump it
+whenever the parser changes what it returns for the same file.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from biobitbot.utils import config
+from biobitbot.utils.count_matrix import CountMatrix, parseCountMatrix
+from biobitbot.utils.count_matrix import parseCountMatrixVersion
+from biobitbot.plots.sql_data_table import SqlDataTable
+
+logger = logging.getLogger(__name__)
+
+stats = {'hits': 0, 'misses': 0, 'saved': 0.0}
+
+
+def fileDigest(filename, blockSize=1 << 20):
+	digest = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(blockSize), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def cacheKey(filename, kind, version, params=(), byContent=False):
+	if byContent:
+		key = [fileDigest(filename), kind, version] + list(params)
+	else:
+		st = os.stat(filename)
+		key = [os.path.realpath(filename), st.st_size, st.st_mtime, kind, version] + list(params)
+	key = '\t'.join(str(k) for k in key)
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cachedParse(filename, kind, version, parse, save, load, params=(), byContent=False):
+	"""
+	Return parse(), taking it from the cache if this exact file has been
+	parsed before.
+
+	@parameter filename - the input file, used to key the cache entry
+	@parameter kind - the kind of table, eg. 'count_matrix'
+	@parameter version - version of the parser. Bump it when parsing changes.
+	@parameter parse - function with no arguments returning the parsed table
+	@parameter save - function (table, entryDir) writing the arrays to
+						entryDir and returning a JSON serialisable dict of labels
+	@parameter load - function (entryDir, labels) returning the table
+	@parameter params - other arguments that change the parsed result
+	@parameter byContent - key the entry on a hash of the file's contents
+							rather than its path, size and mtime
+
+	@return - the parsed table
+	"""
+	if not config.parse_cache:
+		return parse()
+
+	try:
+		entryDir = os.path.join(config.parse_cache_dir, cacheKey(filename, kind, version, params, byContent))
+	except OSError:
+		return parse()
+	metaFn = os.path.join(entryDir, 'meta.json')
+
+	if os.path.exists(metaFn):
+		start = time.time()
+		try:
+			with io.open(metaFn, 'r', encoding='utf-8') as mF:
+				meta = json.load(mF)
+			table = load(entryDir, meta['labels'])
+		except (IOError, OSError, ValueError, KeyError) as e:
+			logger.debug("Couldn't load cached {} for {}: {}".format(kind, filename, e))
+		else:
+			loadTime = time.time() - start
+			stats['hits'] += 1
+			stats['saved'] += max(0.0, meta['parse_time'] - loadTime)
+			logger.debug("Parse cache hit for {}: loaded in {:.2f}s, parsing took {:.2f}s".format(
+							filename, loadTime, meta['parse_time']))
+			return table
+
+	start = time.time()
+	table = parse()
+	parseTime = time.time() - start
+	stats['misses'] += 1
+	logger.debug("Parse cache miss for {}: parsed in {:.2f}s".format(filename, parseTime))
+
+	tmpDir = None
+	try:
+		if not os.path.isdir(config.parse_cache_dir):
+			os.makedirs(config.parse_cache_dir)
+		tmpDir = tempfile.mkdtemp(dir=config.parse_cache_dir)
+		meta = {
+			'source': os.path.realpath(filename),
+			'kind': kind,
+			'version': version,
+			'parse_time': parseTime,
+			'labels': save(table, tmpDir)
+		}
+		writeJson(os.path.join(tmpDir, 'meta.json'), meta)
+		os.rename(tmpDir, entryDir)
+	except Exception as e:
+		# The cache is only an optimisation, a failure to write it mustn't fail the parse
+		logger.debug("Couldn't cache parsed {} for {}: {}".format(kind, filename, e))
+		if tmpDir is not None:
+			shutil.rmtree(tmpDir, ignore_errors=True)
+	return table
+
+
+def writeJson(filename, data):
+	"""
+	Write data to filename as ASCII JSON. It's written as bytes because on
+	py2 json.dumps returns a byte str or unicode depending on its input,
+	and a text mode file only takes unicode.
+	"""
+	with io.open(filename, 'wb') as f:
+		f.write(json.dumps(data).encode('ascii'))
+
+
+def logSummary():
+	if stats['hits'] + stats['misses'] == 0:
+		return
+	logger.info("Parse cache: {} hits, {} misses, saved {:.1f}s of parsing".format(
+					stats['hits'], stats['misses'], stats['saved']))
+
+
+def saveCountMatrix(matrix, entryDir):
+	np.save(os.path.join(entryDir, 'data.npy'), np.ascontiguousarray(matrix.data))
+	return {'name': matrix.name, 'rowNames': matrix.rowNames, 'colNames': matrix.colNames}
+
+
+def loadCountMatrix(entryDir, labels):
+	data = np.load(os.path.join(entryDir, 'data.npy'), mmap_mode='r')
+	return CountMatrix(labels['name'], labels['rowNames'], labels['colNames'], data)
+
+
+def cachedCountMatrix(filename, name, idcol, dtype=np.float64, cleanHeader=None):
+	"""
+	parseCountMatrix, going through the parse cache. The values of a
+	cached matrix are a read only memory map.
+	"""
+	parse = lambda: parseCountMatrix(filename, name, idcol, dtype=dtype, cleanHeader=cleanHeader)
+	params = (name, idcol, np.dtype(dtype).name)
+	return cachedParse(filename, 'count_matrix', parseCountMatrixVersion, parse,
+						saveCountMatrix, loadCountMatrix, params=params)
+
+
+def saveSqlDataTable(table, entryDir):
+	"""
+	Save every FLOAT column as one 2D float64 array. TEXT columns, and FLOAT
+	columns holding values numpy can't convert (eg. 'NA'), are kept as
+	lists in the labels.
+	"""
+	cols, rows = table.getTable()
+	rows = list(rows)
+	columns = []
+	numeric = []
+	for i, col in enumerate(cols):
+		vals = [row[i] for row in rows]
+		column = {'name': col.name, 'dataType': col.dataType}
+		if col.dataType == 'FLOAT':
+			try:
+				numeric.append(np.array(vals, dtype=np.float64))
+				column['index'] = len(numeric) - 1
+			except (ValueError, TypeError):
+				column['values'] = vals
+		else:
+			column['values'] = vals
+		columns.append(column)
+	if len(numeric) > 0:
+		np.save(os.path.join(entryDir, 'data.npy'), np.column_stack(numeric))
+	return {'name': table.name, 'columns': columns}
+
+
+def loadSqlDataTable(entryDir, labels):
+	columns = labels['columns']
+	data = None
+	if any('index' in column for column in columns):
+		data = np.load(os.path.join(entryDir, 'data.npy'), mmap_mode='r')
+	table = SqlDataTable(labels['name'])
+	values = []
+	for column in columns:
+		table.addColumnInfo(column['name'], column['dataType'])
+		if 'index' in column:
+			values.append(data[:, column['index']].tolist())
+		else:
+			values.append(column['values'])
+	table.initSqlTable()
+	table.addManyRows(zip(*values))
+	return table
+
+
+def cachedSqlDataTable(filename, parse, version, params=()):
+	"""
+	Parse a table into a SqlDataTable with parse(filename), going through
+	the parse cache. Cached tables are loaded into SQLite from binary
+	arrays rather than from text.
+	"""
+	params = (parse.__module__, parse.__name__) + tuple(params)
+	return cachedParse(filename, 'sql_data_table', version, lambda: parse(filename),
+						saveSqlDataTable, loadSqlDataTable, params=params)
@@ -5,13 +5,30 @@ module. Is available to subsequent modules. Contains
 helper functions to generate markup for report. """
 
 from __future__ import print_function
+import base64
 from collections import defaultdict, OrderedDict
 import fnmatch
+import glob
+import hashlib
 import io
 import json
+from multiprocessing.pool import ThreadPool
 import mimetypes
 import os
+import re
+import stat
+import tempfile
+import time
 import yaml
+import zlib
+
+try:
+    from os import scandir # py3.5+
+except ImportError:
+    try:
+        from scandir import scandir # py2 backport
+    except ImportError:
+        scandir = None
 
 from biobitbot import logger
 from biobitbot.utils import config
@@ -37,11 +54,321 @@ data_sources = defaultdict(lambda:defaultdict(lambda:defaultdict()))
 num_hc_plots = 0
 num_mpl_plots = 0
 
+# Module HTML and plot data, written here as modules produce them instead of
+# being held in memory, and read back a piece at a time when the template is
+# streamed to the report file. See SpooledHtml.
+spool = None
+
+# Plot data shared between plots, keyed by a hash of its JSON. Each payload
+# is spooled and written into the report once, plots refer to it by key.
+datasets = OrderedDict()
+dataset_stats = {'refs': 0, 'bytes_in': 0, 'bytes_out': 0}
+# Payloads shorter than this cost less inline than as a reference
+dataset_ref_min_bytes = 64
+# With config.report_compress_data, payloads at least this long are gzipped
+dataset_compress_min_bytes = 1024
+# With config.report_lazy_data, payloads at least this long get their own file
+dataset_file_min_bytes = 4096
+# Path of the dataset files relative to the report, once written
+datasets_src = None
+
 # Make a list of files to search
 files = list()
+
+# Index of positions in `files` for every compiled search pattern,
+# filled in a single pass by get_filelist()
+files_by_pattern = defaultdict(list)
+sp_matcher = None
+
+# Bump this if the format of the cached file list changes
+filelist_cache_version = 1
+
+# Every file found under the analysis directories (before any filtering)
+# as (analysis directory, path relative to it). 'glob' search patterns
+# are resolved against this instead of the filesystem.
+manifest = list()
+glob_matches = defaultdict(list)
+glob_matcher = None
+
+class SearchPatternMatcher(object):
+    """ Combined matcher for all filename search patterns. Patterns
+    without wildcards go in a hash of exact names, patterns of the form
+    '*suffix' are bucketed by suffix length and anything else is compiled
+    to a single regex. Every pattern is compiled exactly once. """
+
+    def __init__(self, patterns=[]):
+        self.patterns = set()
+        self.exact = defaultdict(list)
+        self.suffixes = defaultdict(lambda: defaultdict(list))
+        self.regexes = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        if pattern in self.patterns:
+            return
+        self.patterns.add(pattern)
+        if not any(c in pattern for c in '*?['):
+            self.exact[os.path.normcase(pattern)].append(pattern)
+        elif pattern.startswith('*') and not any(c in pattern[1:] for c in '*?['):
+            suffix = os.path.normcase(pattern[1:])
+            self.suffixes[len(suffix)][suffix].append(pattern)
+        else:
+            self.regexes.append((re.compile(fnmatch.translate(os.path.normcase(pattern))), pattern))
+
+    def match(self, fn):
+        """ Return a list of every pattern matching the filename fn """
+        fn = os.path.normcase(fn)
+        matched = list(self.exact.get(fn, []))
+        for length, bucket in self.suffixes.items():
+            if len(fn) >= length:
+                matched.extend(bucket.get(fn[len(fn)-length:], []))
+        for regex, pattern in self.regexes:
+            if regex.match(fn):
+                matched.append(pattern)
+        return matched
+
+class GlobPatternMatcher(object):
+    """ Combined matcher for the path search patterns given under 'glob'
+    keys. Paths relative to an analysis directory are matched one path
+    component at a time, the way glob.glob would, so '*' never crosses
+    a directory and does not match hidden files. Patterns with a literal
+    directory part are bucketed by that directory, leaving just one
+    basename regex to try for each file. """
+
+    def __init__(self, patterns=[]):
+        self.patterns = set()
+        self.by_dir = defaultdict(list)
+        self.other = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    @staticmethod
+    def split(path):
+        path = os.path.normpath(os.path.normcase(path))
+        return path.split(os.sep)
+
+    @staticmethod
+    def compile_part(part):
+        return (re.compile(fnmatch.translate(part)), part.startswith('.'))
+
+    @staticmethod
+    def match_part(compiled, name):
+        regex, dotted = compiled
+        if name.startswith('.') and not dotted:
+            return False
+        return regex.match(name) is not None
+
+    def add(self, pattern):
+        if pattern in self.patterns:
+            return
+        self.patterns.add(pattern)
+        parts = self.split(pattern)
+        if not any(glob.has_magic(p) for p in parts[:-1]):
+            self.by_dir[os.sep.join(parts[:-1])].append((self.compile_part(parts[-1]), pattern))
+        else:
+            self.other.append(([self.compile_part(p) for p in parts], pattern))
+
+    def match(self, relpath):
+        """ Return a list of every pattern matching relpath """
+        parts = self.split(relpath)
+        matched = []
+        for compiled, pattern in self.by_dir.get(os.sep.join(parts[:-1]), []):
+            if self.match_part(compiled, parts[-1]):
+                matched.append(pattern)
+        for compiled_parts, pattern in self.other:
+            if len(compiled_parts) == len(parts) and \
+                    all(self.match_part(c, p) for c, p in zip(compiled_parts, parts)):
+                matched.append(pattern)
+        return matched
+
+def iter_search_patterns(sp, key='fn'):
+    """ Walk the nested config.sp dict and yield every pattern string
+    given under `key`. Values can be a string or a list of strings. """
+    if not isinstance(sp, dict):
+        return
+    for k, v in sp.items():
+        if k == key:
+            if isinstance(v, list):
+                for pattern in v:
+                    yield pattern
+            else:
+                yield v
+        elif isinstance(v, dict):
+            for pattern in iter_search_patterns(v, key):
+                yield pattern
+
+def compile_search_patterns():
+    """ Compile every filename and glob pattern in config.sp into two matchers """
+    global sp_matcher, glob_matcher
+    sp_matcher = SearchPatternMatcher(iter_search_patterns(config.sp, 'fn'))
+    glob_matcher = GlobPatternMatcher(iter_search_patterns(config.sp, 'glob'))
+    logger.debug("Compiled {} filename and {} glob search patterns".format(
+        len(sp_matcher.patterns), len(glob_matcher.patterns)))
+
+def get_pattern_matches(pattern):
+    """ Return the positions in report.files of all files with a name
+    matching pattern. Patterns that were not in config.sp are matched
+    against the file list the first time they are asked for and are
+    then kept in the index like any other. """
+    if sp_matcher is None:
+        compile_search_patterns()
+    if pattern not in sp_matcher.patterns:
+        sp_matcher.add(pattern)
+        regex = re.compile(fnmatch.translate(os.path.normcase(pattern)))
+        files_by_pattern[pattern] = [i for i, f in enumerate(files) if regex.match(os.path.normcase(f['fn']))]
+    return files_by_pattern.get(pattern, [])
+
+def get_glob_matches(pattern):
+    """ Return the files matching a glob pattern as dicts with 'root' (the
+    analysis directory) and 'fn' (the path relative to it), sorted by path.
+    Patterns are resolved against report.manifest, so the filesystem is
+    not touched. Absolute patterns fall back to glob.glob. """
+    if os.path.isabs(pattern):
+        return [{'root': os.path.dirname(fn), 'fn': os.path.basename(fn)} for fn in sorted(glob.glob(pattern))]
+    if glob_matcher is None:
+        compile_search_patterns()
+    if pattern not in glob_matcher.patterns:
+        glob_matcher.add(pattern)
+        single = GlobPatternMatcher([pattern])
+        glob_matches[pattern] = [{'root': d, 'fn': rel} for d, rel in manifest if single.match(rel)]
+    return sorted(glob_matches.get(pattern, []), key=lambda f: (f['root'], f['fn']))
+
+def scan_dir(args):
+    """ List one directory with scandir. Returns the files in it as
+    (name, size) tuples, using the stat cached on each directory entry,
+    and the names of the subdirectories that are not ignored. If the
+    directory mtime matches a cached listing, the cached listing is
+    returned without reading the directory. """
+    path, relroot, cached = args
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        logger.debug("Couldn't stat directory when looking for files: {}".format(path))
+        return path, relroot, [], [], None, False
+    if cached is not None and cached.get('mtime') == mtime:
+        return path, relroot, [tuple(f) for f in cached['files']], cached['subdirs'], mtime, True
+    filenames = []
+    subdirs = []
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                try:
+                    if entry.is_dir():
+                        if not any(fnmatch.fnmatch(entry.name, n) for n in config.fn_ignore_dirs):
+                            subdirs.append(entry.name)
+                    elif entry.is_file():
+                        filenames.append((entry.name, entry.stat().st_size))
+                except OSError:
+                    filenames.append((entry.name, None))
+        else:
+            for name in os.listdir(path):
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except OSError:
+                    filenames.append((name, None))
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if not any(fnmatch.fnmatch(name, n) for n in config.fn_ignore_dirs):
+                        subdirs.append(name)
+                elif stat.S_ISREG(st.st_mode):
+                    filenames.append((name, st.st_size))
+    except OSError:
+        logger.debug("Couldn't list directory when looking for files: {}".format(path))
+    return path, relroot, filenames, subdirs, mtime, False
+
+def walk_directory(directory, pool, cache={}, listings=None):
+    """ Walk a directory tree one level at a time, listing all the
+    directories of a level in parallel on the thread pool. Yields
+    (root, relroot, [(filename, size)], cached) for every directory,
+    where cached is True if the listing came from the cache.
+    :param cache: listings from a previous run, keyed on relroot. Only
+                  directories whose mtime has changed are read again.
+    :param listings: optional dict, filled with the listing of every
+                     directory to be saved for the next run.
+    """
+    pending = [(directory, '')]
+    while len(pending) > 0:
+        subdirs = []
+        args = [(path, relroot, cache.get(relroot)) for path, relroot in pending]
+        for root, relroot, filenames, children, mtime, hit in pool.imap(scan_dir, args):
+            if listings is not None:
+                listings[relroot] = {'mtime': mtime, 'files': filenames, 'subdirs': children, 'hit': hit}
+            yield root, relroot, filenames, hit
+            subdirs.extend((os.path.join(root, c), os.path.join(relroot, c)) for c in children)
+        pending = subdirs
+
+def filelist_cache_fn(directory):
+    """ Path of the cached file list for an analysis directory """
+    key = hashlib.sha1(os.path.realpath(directory).encode('utf-8')).hexdigest()
+    return os.path.join(config.filelist_cache_dir, 'filelist_{}.json'.format(key))
+
+def load_filelist_cache(directory):
+    """ Load the directory listings saved by a previous run. Returns an
+    empty dict if there is no usable cache or a rescan was asked for. """
+    if not config.filelist_cache or config.rescan:
+        return {}
+    try:
+        with io.open(filelist_cache_fn(directory), 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if cache.get('version') != filelist_cache_version or cache.get('fn_ignore_dirs') != config.fn_ignore_dirs:
+        return {}
+    return cache.get('dirs', {})
+
+def save_filelist_cache(directory, listings, start):
+    """ Save the directory listings for the next run. A directory modified
+    within a second of the walk starting could change again without its
+    mtime moving, so its listing is stored without an mtime and will be
+    read again next time. """
+    if not config.filelist_cache:
+        return
+    dirs = {}
+    for relroot, listing in listings.items():
+        mtime = listing['mtime']
+        if mtime is not None and mtime >= start - 1:
+            mtime = None
+        dirs[relroot] = {'mtime': mtime, 'files': listing['files'], 'subdirs': listing['subdirs']}
+    # parse_cache imports the plotting modules, which import this module
+    from biobitbot.utils.parse_cache import writeJson
+    cache_fn = filelist_cache_fn(directory)
+    tmp_fn = '{}.{}.tmp'.format(cache_fn, os.getpid())
+    try:
+        if not os.path.isdir(config.filelist_cache_dir):
+            os.makedirs(config.filelist_cache_dir)
+        writeJson(tmp_fn, {
+            'version': filelist_cache_version,
+            'directory': os.path.realpath(directory),
+            'fn_ignore_dirs': config.fn_ignore_dirs,
+            'dirs': dirs
+        })
+        os.rename(tmp_fn, cache_fn)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        # The cache is only an optimisation, never fail the run over it
+        logger.debug("Couldn't write file list cache '{}': {}".format(cache_fn, e))
+        try:
+            os.remove(tmp_fn)
+        except OSError:
+            pass
+
 def get_filelist():
     
-    def add_file(fn, root):
+    compile_search_patterns()
+    files_by_pattern.clear()
+    glob_matches.clear()
+    del manifest[:]
+    
+    def add_path(fn, root, relroot, directory, filesize, cached=False):
+        
+        # Resolve glob patterns against every file, as glob.glob would have
+        relpath = os.path.join(relroot, fn)
+        manifest.append((directory, relpath))
+        for pattern in glob_matcher.match(relpath):
+            glob_matches[pattern].append({'root': directory, 'fn': relpath})
+        add_file(fn, root, filesize, cached)
+    
+    def add_file(fn, root, filesize, cached=False):
         
         # Check that we don't want to ignore this file
         i_matches = [n for n in config.fn_ignore_files if fnmatch.fnmatch(fn, n)]
@@ -50,7 +377,7 @@ def get_filelist():
             return None
     
         # Use mimetypes to exclude binary files where possible
-        (ftype, encoding) = mimetypes.guess_type(os.path.join(root, fn))
+        (ftype, encoding) = mimetypes.guess_type(fn)
         if encoding is not None:
             logger.debug("Ignoring file as is encoded: {}".format(fn))
             return None
@@ -59,29 +386,56 @@ def get_filelist():
             return None
         
         # Limit search to files under 5MB to avoid 30GB FastQ files etc.
-        try:
-            filesize = os.path.getsize(os.path.join(root,fn))
-        except (IOError, OSError, ValueError, UnicodeDecodeError):
+        # The size comes from the stat made while walking the directory.
+        # A cached listing is only checked against its directory's mtime,
+        # which doesn't change when a file is rewritten in place, so the
+        # size of a file from one is read again.
+        if cached:
+            try:
+                filesize = os.path.getsize(os.path.join(root, fn))
+            except OSError:
+                filesize = None
+        if filesize is None:
             logger.debug("Couldn't read file when checking filesize: {}".format(fn))
-        else:
-            if filesize > config.log_filesize_limit:
-                logger.debug("Ignoring file as too large: {}".format(fn))
-                return None
+        elif filesize > config.log_filesize_limit:
+            logger.debug("Ignoring file as too large: {}".format(fn))
+            return None
         
-        # Looks good! Remember this file
+        # Looks good! Remember this file and index it against the search patterns
+        for pattern in sp_matcher.match(fn):
+            files_by_pattern[pattern].append(len(files))
         files.append({
             'root': root,
             'fn': fn
         })
     
     # Go through the analysis directories
-    for directory in config.analysis_dir:
-        if os.path.isdir(directory):
-            for root, dirnames, filenames in os.walk(directory, followlinks=True):
-                for fn in filenames:
-                    add_file(fn, root)
-        elif os.path.isfile(directory):
-            add_file(os.path.basename(directory), os.path.dirname(directory))
+    start = time.time()
+    pool = ThreadPool(max(1, config.filelist_threads))
+    try:
+        for directory in config.analysis_dir:
+            if os.path.isdir(directory):
+                cache = load_filelist_cache(directory)
+                listings = dict()
+                for root, relroot, filenames, cached in walk_directory(directory, pool, cache, listings):
+                    for fn, filesize in filenames:
+                        add_path(fn, root, relroot, directory, filesize, cached)
+                hits = len([l for l in listings.values() if l['hit']])
+                logger.debug("Reused {} of {} directory listings from the file list cache for {}".format(
+                    hits, len(listings), directory))
+                save_filelist_cache(directory, listings, start)
+            elif os.path.isfile(directory):
+                parent = os.path.dirname(directory) or os.curdir
+                add_path(os.path.basename(directory), parent, '', parent, os.path.getsize(directory))
+    finally:
+        pool.close()
+        pool.join()
+    walk_time = time.time() - start
+    
+    logger.debug("Walked {} files in {:.2f}s ({:.0f} files/sec, {} threads)".format(
+        len(manifest), walk_time, len(manifest) / max(walk_time, 1e-6), config.filelist_threads))
+    logger.debug("Indexed {} files against {} search patterns".format(len(files), len(files_by_pattern)))
+    logger.debug("Manifest holds {} files, {} glob patterns matched".format(len(manifest), len(glob_matches)))
 
 
 def general_stats_build_html():
@@ -282,6 +636,171 @@ def general_stats_build_table():
     return None
     
 
+def dataset_ref(payload):
+    """ Register a JSON serialisable payload in the report's datasets and
+    return a reference to put in mqc_plots instead. Payloads with the same
+    content share one entry. Small payloads are returned as they are.
+    :param: payload - the data, eg. a series' points or a packed column
+    :return: {'dataset_ref': key}, or payload """
+    encoded = json.dumps(payload, sort_keys=True)
+    if len(encoded) < dataset_ref_min_bytes:
+        return payload
+    key = hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:20]
+    ref = {'dataset_ref': key}
+    dataset_stats['refs'] += 1
+    dataset_stats['bytes_in'] += len(encoded)
+    dataset_stats['bytes_out'] += len(json.dumps(ref))
+    if key not in datasets:
+        datasets[key] = spool_write(encoded)
+        dataset_stats['bytes_out'] += len(encoded)
+    return ref
+
+def share_plot_data(plotdata):
+    """ Swap the data of every series in a plot's datasets, a list of
+    series or a list of lists of series, for dataset references. Packed
+    series (see biobitbot.plots.packed) share each column and their point
+    names separately, so plots with an axis in common share that column. """
+    if isinstance(plotdata, list):
+        return [share_plot_data(item) for item in plotdata]
+    if not isinstance(plotdata, dict):
+        return dataset_ref(plotdata)
+    series = dict(plotdata)
+    if 'packed' in series:
+        packed = dict(series['packed'])
+        packed['columns'] = [dataset_ref(col) for col in packed['columns']]
+        if 'names' in packed:
+            packed['names'] = dataset_ref(packed['names'])
+        series['packed'] = packed
+    elif 'data' in series:
+        series['data'] = dataset_ref(series['data'])
+    return series
+
+def datasets_js():
+    """ Javascript defining mqc_datasets, for the report template, yielded
+    a payload at a time so it can be streamed from the spool. With
+    config.report_compress_data large payloads go in mqc_datasets_gz
+    instead, as base64 gzipped JSON, to be inflated when first plotted.
+    Payloads written to their own files by write_dataset_files are left
+    out, the report loads them from datasets_src. """
+    compressed = []
+    yield 'mqc_datasets = {'
+    sep = ''
+    for key, span in datasets.items():
+        if datasets_src is not None and span[1] >= dataset_file_min_bytes:
+            continue
+        if config.report_compress_data and span[1] >= dataset_compress_min_bytes:
+            compressed.append((key, span))
+            continue
+        yield script_safe(u'{}"{}": {}'.format(sep, key, spool_read(span)))
+        sep = ', '
+    yield '};'
+    if len(compressed) > 0:
+        yield '\nmqc_datasets_gz = {'
+        for i, (key, span) in enumerate(compressed):
+            yield '{}"{}": "{}"'.format(', ' if i > 0 else '', key, gzip_base64(spool_read(span)))
+        yield '};'
+    if datasets_src is not None:
+        yield '\nmqc_datasets_src = {};'.format(json.dumps(datasets_src))
+
+def write_dataset_files(directory, src):
+    """ Write each large payload to a javascript file of its own, for the
+    report to load when a plot using it scrolls into view. They're loaded
+    with script tags rather than fetched, which browsers refuse for
+    reports opened from disk.
+    :param: directory - where to write the files
+    :param: src - the directory's path relative to the report """
+    global datasets_src
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    num_files = 0
+    for key, span in datasets.items():
+        if span[1] < dataset_file_min_bytes:
+            continue
+        if config.report_compress_data and span[1] >= dataset_compress_min_bytes:
+            js = u'mqc_datasets_gz["{}"] = "{}";'.format(key, gzip_base64(spool_read(span)))
+        else:
+            js = u'mqc_datasets["{}"] = {};'.format(key, spool_read(span))
+        with io.open(os.path.join(directory, '{}.js'.format(key)), 'w', encoding='utf-8') as f:
+            f.write(js)
+            f.write(u'\nmqc_dataset_loaded("{}");\n'.format(key))
+        num_files += 1
+    datasets_src = src
+    logger.info("Plot data   : {} files in {}".format(num_files, os.path.relpath(directory)))
+
+def script_safe(js):
+    """ Keep a '</script>' in inline data from closing the script tag """
+    return js.replace('</', '<\\/')
+
+def gzip_base64(text):
+    """ Gzip a string, with no timestamp so reports are reproducible, and
+    base64 encode it """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = compressor.compress(text.encode('utf-8')) + compressor.flush()
+    return base64.b64encode(data).decode('ascii')
+
+def log_dataset_savings():
+    if dataset_stats['refs'] == 0:
+        return
+    logger.info("Plot datasets: {} references to {} unique payloads, saved {:.1f} kB".format(
+                    dataset_stats['refs'], len(datasets),
+                    (dataset_stats['bytes_in'] - dataset_stats['bytes_out']) / 1000.0))
+
+def spool_write(text):
+    """ Append text to the report's spool file
+    :return: (offset, length) of its UTF-8 bytes in the spool """
+    global spool
+    if spool is None:
+        spool = tempfile.SpooledTemporaryFile(max_size=config.report_spool_max_memory)
+    data = text if isinstance(text, bytes) else text.encode('utf-8')
+    spool.seek(0, os.SEEK_END)
+    offset = spool.tell()
+    spool.write(data)
+    return offset, len(data)
+
+def spool_read(span):
+    """ Read back text written by spool_write """
+    offset, length = span
+    spool.seek(offset)
+    return spool.read(length).decode('utf-8')
+
+class SpooledHtml(object):
+    """ HTML built up a piece at a time, eg. a module's intro or a section's
+    content. Supports += like a string, but keeps the pieces in the report's
+    spool file, so a module holds only the plot it is building in memory.
+    The template writes it out a piece at a time, see html_chunks. """
+
+    def __init__(self, text=''):
+        self.spans = []
+        self.append(text)
+
+    def append(self, text):
+        if isinstance(text, SpooledHtml):
+            self.spans.extend(text.spans)
+        elif text:
+            self.spans.append(spool_write(text))
+
+    def __iadd__(self, text):
+        self.append(text)
+        return self
+
+    def __len__(self):
+        return sum(length for _, length in self.spans)
+
+    def chunks(self):
+        for span in self.spans:
+            yield spool_read(span)
+
+    def __str__(self):
+        return u''.join(self.chunks())
+    __unicode__ = __str__
+
+def html_chunks(html):
+    """ The pieces of a SpooledHtml, or a plain HTML string, for the template
+    to write out one at a time. Nothing for None or an empty string. """
+    if isinstance(html, SpooledHtml):
+        return html.chunks()
+    return [html] if html else []
+
 def write_data_file(data, fn, sort_cols=False, data_format=None):
     """ Write a data file to the report directory. Will not do anything
     if config.data_dir is not set.
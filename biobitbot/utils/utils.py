@@ -3,6 +3,8 @@ import math
 from biobitbot.plots.sql_data_table import SqlDataTable
 import csv
 
+parseDiffExpTableVersion = 1
+
 def openMaybeZip(fname):
 	end = fname.split('.')[-1]
 	if end == 'gz':
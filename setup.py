@@ -77,7 +77,8 @@ setup(
         'simplejson',
         'pyyaml',
         'click',
-        'matplotlib'
+        'matplotlib',
+        'numpy'
     ],
     entry_points = {
         'biobitbot.analyses.v1': [
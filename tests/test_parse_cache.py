@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Parse cache round trips: a cold cache parses and saves an entry, a warm
+cache loads it back without parsing again.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from biobitbot.utils import config, parse_cache
+from biobitbot.analyses.microbiome.microbiome import parsePhylogenyTree, parsePhylogenyTreeVersion
+from biobitbot.analyses.microbiome.tree import saveTree, loadTree
+
+ranks = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+rootOffset = 1
+
+lineages = [
+	['Bacteria', 'Firmicutes', 'Bacilli', 'Lactobacillales', 'Lactobacillaceae', 'Lactobacillus', 'L. acidophilus'],
+	['Bacteria', 'Firmicutes', 'Bacilli', 'Lactobacillales', 'Lactobacillaceae', 'Lactobacillus', 'L. casei'],
+	['Bacteria', 'Bacteroidetes', 'Bacteroidia', 'Bacteroidales', 'Bacteroidaceae', 'Bacteroides', 'B. fragilis'],
+]
+
+
+class ParseCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.saved = (config.parse_cache, config.parse_cache_dir)
+		config.parse_cache = True
+		config.parse_cache_dir = os.path.join(self.tmpDir, 'cache')
+		parse_cache.stats.update({'hits': 0, 'misses': 0, 'saved': 0.0})
+
+		self.treeFn = os.path.join(self.tmpDir, 'taxonomy.tsv')
+		with open(self.treeFn, 'w') as tF:
+			tF.write('\t'.join(ranks) + '\n')
+			for lineage in lineages:
+				tF.write('\t'.join(lineage) + '\n')
+
+	def tearDown(self):
+		config.parse_cache, config.parse_cache_dir = self.saved
+		shutil.rmtree(self.tmpDir)
+
+	def cachedTree(self, offset=rootOffset):
+		parses = []
+		def parse():
+			parses.append(self.treeFn)
+			return parsePhylogenyTree(self.treeFn, ranks, offset)
+		tree = parse_cache.cachedParse(self.treeFn, 'phylogeny_tree', parsePhylogenyTreeVersion,
+										parse, saveTree, loadTree, params=ranks + [offset], byContent=True)
+		return tree, len(parses)
+
+	def assertSameTree(self, tree, expected):
+		self.assertEqual(tree.size, expected.size)
+		self.assertEqual(tree.rootOffset, expected.rootOffset)
+		self.assertEqual(list(tree.names), list(expected.names))
+		for name in ['parents', 'nameIds', 'heights', 'ranks']:
+			np.testing.assert_array_equal(getattr(tree, name), getattr(expected, name))
+		np.testing.assert_array_equal(tree.preorder(), expected.preorder())
+		self.assertEqual(tree.nodeByName, expected.nodeByName)
+
+	def test_cold_miss_then_warm_hit(self):
+		expected = parsePhylogenyTree(self.treeFn, ranks, rootOffset)
+
+		cold, parses = self.cachedTree()
+		self.assertEqual(parses, 1)
+		self.assertEqual(parse_cache.stats['misses'], 1)
+		self.assertEqual(len(os.listdir(config.parse_cache_dir)), 1)
+		self.assertSameTree(cold, expected)
+
+		warm, parses = self.cachedTree()
+		self.assertEqual(parses, 0)
+		self.assertEqual(parse_cache.stats['hits'], 1)
+		self.assertSameTree(warm, expected)
+
+	def test_copy_of_file_hits_same_entry(self):
+		self.cachedTree()
+		copyFn = os.path.join(self.tmpDir, 'copy.tsv')
+		shutil.copy(self.treeFn, copyFn)
+		self.treeFn = copyFn
+		tree, parses = self.cachedTree()
+		self.assertEqual(parses, 0)
+		self.assertEqual(parse_cache.stats['hits'], 1)
+
+	def test_root_offset_is_part_of_the_key(self):
+		self.cachedTree()
+		tree, parses = self.cachedTree(offset=2)
+		self.assertEqual(parses, 1)
+		self.assertEqual(tree.rootOffset, 2)
+		np.testing.assert_array_equal(tree.ranks, parsePhylogenyTree(self.treeFn, ranks, 2).ranks)
+
+
+if __name__ == '__main__':
+	unittest.main()